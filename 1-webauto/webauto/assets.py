@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Classes to prepare assets for upload.
+
+    - AssetPolicy decides the Content-Encoding and Cache-Control of a key
+    - Compressor keeps pre-compressed copies of files keyed by ETag
+    - decompress decodes pulled objects stored with a Content-Encoding
+
+Policies are read from a JSON file like assets.tmpl.json.  Objects are
+stored compressed, so S3 and CloudFront serve the encoded bytes to
+every viewer; only use an encoding all your viewers accept.
+"""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from fnmatch import fnmatch
+
+from webauto import util
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+EXTENSIONS = {'gzip': 'gz', 'br': 'br'}
+
+
+def can_decode(encoding):
+    """Check if content stored with encoding can be decoded here."""
+    return encoding in EXTENSIONS and (encoding != 'br' or brotli)
+
+
+def decompress(path, encoding):
+    """Replace the file at path by its content decoded from encoding."""
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(path),
+                                prefix='.webauto-', suffix='.tmp')
+    try:
+        with open(path, 'rb') as source, os.fdopen(fd, 'wb') as out:
+            if encoding == 'br':
+                out.write(brotli.decompress(source.read()))
+            else:
+                with gzip.GzipFile(mode='rb', fileobj=source) as decoded:
+                    shutil.copyfileobj(decoded, out)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+class AssetPolicy:
+    """Decide how each key is encoded and cached."""
+
+    DEFAULT_COMPRESS = [
+        'text/*', 'application/javascript', 'application/json',
+        'application/xml', 'image/svg+xml', 'application/wasm'
+    ]
+
+    def __init__(self, cache_control=None, compress=None, encoding='gzip',
+                 min_size=1024):
+        """Create AssetPolicy object.
+
+        cache_control is a list of (key glob, Cache-Control value), the
+        first glob matching a key wins.  compress is a list of content
+        type globs to compress with encoding ('gzip' or 'br').
+        """
+        if encoding not in EXTENSIONS:
+            raise ValueError('Unknown encoding {}'.format(encoding))
+        if encoding == 'br' and brotli is None:
+            raise ValueError('The brotli package is needed for br encoding')
+
+        self.cache_control_rules = cache_control or []
+        self.compress = self.DEFAULT_COMPRESS if compress is None \
+            else compress
+        self.encoding = encoding
+        self.min_size = min_size
+
+    @classmethod
+    def from_file(cls, path):
+        """Load AssetPolicy from a JSON config file."""
+        with open(path) as f:
+            config = json.load(f)
+
+        return cls(
+            cache_control=[(rule['pattern'], rule['value'])
+                           for rule in config.get('cache_control', [])],
+            compress=config.get('compress'),
+            encoding=config.get('encoding', 'gzip'),
+            min_size=config.get('min_size', 1024))
+
+    def cache_control(self, key):
+        """Get the Cache-Control header for key, if any rule matches."""
+        for pattern, value in self.cache_control_rules:
+            if fnmatch(key, pattern):
+                return value
+        return None
+
+    def encoding_for(self, content_type, size):
+        """Get the Content-Encoding to store a file with, if any."""
+        if size < self.min_size:
+            return None
+        for pattern in self.compress:
+            if fnmatch(content_type, pattern):
+                return self.encoding
+        return None
+
+
+class Compressor:
+    """Keep compressed copies of files, named by the source ETag.
+
+    A file whose ETag is unchanged (and usually cached) is never
+    compressed twice.
+    """
+
+    def __init__(self, directory=None):
+        """Create Compressor object storing files in directory."""
+        self.directory = directory or util.cache_dir() / 'compressed'
+        os.makedirs(str(self.directory), exist_ok=True)
+
+    def compressed_path(self, etag, encoding):
+        """Get where the compressed copy of content with etag is kept."""
+        return os.path.join(str(self.directory), '{}.{}'.format(
+            etag.strip('"'), EXTENSIONS[encoding]))
+
+    def compress(self, path, etag, encoding):
+        """Get the path of a compressed copy of path, creating it once."""
+        target = self.compressed_path(etag, encoding)
+        if os.path.exists(target):
+            return target
+
+        fd, temp = tempfile.mkstemp(dir=str(self.directory))
+        try:
+            with open(path, 'rb') as source, os.fdopen(fd, 'wb') as out:
+                if encoding == 'br':
+                    out.write(brotli.compress(source.read()))
+                else:
+                    # A fixed mtime keeps the output, and so its ETag,
+                    # identical across runs.
+                    with gzip.GzipFile(filename='', mode='wb', fileobj=out,
+                                       mtime=0) as compressed:
+                        shutil.copyfileobj(source, compressed)
+            os.replace(temp, target)
+        except BaseException:
+            os.remove(temp)
+            raise
+
+        return target
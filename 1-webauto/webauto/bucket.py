@@ -5,17 +5,44 @@ Class BucketManager to manage S3 functions.
     - Create a Bucket
     - List all Buckets
     - Configure Bucket for it to be used as website
-    - Sync folder from given path to an bucket
+    - Sync folder from given path to an bucket, optionally deleting
+      objects that no longer exist locally
+    - Pull the objects of a bucket down to a folder
 """
 
+import copy
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from hashlib import md5
 import mimetypes
-from functools import reduce
+from collections import deque, namedtuple
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, wait, FIRST_COMPLETED)
 import boto3
 from botocore.exceptions import ClientError
 
 from webauto import util
+from webauto.etag import (
+    as_multipart, compute_etag, candidate_part_sizes, etag_parts)
+from webauto.snapshot import SnapshotWriter, read_snapshot
+from webauto.assets import AssetPolicy, Compressor, can_decode, decompress
+from webauto.resumable import ResumableUpload, part_size_for
+from webauto.walk import walk_files, IgnoreRules, LocalFile
+from webauto.watch import TreeIndex, start_trigger, wait_for_changes
+from webauto.dedup import ContentIndex
+from webauto.regions import RegionResolver
+from webauto.diff import (
+    merge_join, SyncResult, COPY, DELETE, DOWNLOAD, FAILED, KEEP, SKIP,
+    UPLOAD)
+
+# meta is the fingerprint of the headers an object was stored with, or
+# None where it is unknown
+ManifestEntry = namedtuple('ManifestEntry', ['etag', 'size', 'meta'])
+ManifestEntry.__new__.__defaults__ = (None,)
 
 
 
@@ -23,25 +50,84 @@ class BucketManager:
     """Manage an S3 bucket."""
 
     CHUNK_SIZE = 8388608
-
-    def __init__(self, session):
-        """Create and BucketManager object."""
+    QUEUE_FACTOR = 4
+    DELETE_BATCH = 1000
+    DEDUP_MIN_SIZE = 65536
+    RESUMABLE_THRESHOLD = 67108864
+    SNAPSHOT_KEY = '.webauto/manifest.json.gz'
+    SNAPSHOT_MAX_AGE = timedelta(days=1)
+
+    def __init__(self, session, etag_cache=None, asset_policy=None,
+                 controller=None, resumable=False):
+        """Create and BucketManager object.
+
+        If an ETagCache is given, local ETags are looked up there before
+        reading the files.  If an AssetPolicy is given, synced files are
+        compressed and given Cache-Control headers following it.  If a
+        TransferController is given, uploads and copies run through it.
+        With resumable, files over RESUMABLE_THRESHOLD are uploaded with
+        a checkpointed ResumableUpload.
+
+        Buckets are always used through an S3 resource of their own
+        region, so requests never go through a cross-region redirect.
+        """
+        self.session = session
         self.s3 = session.resource('s3')
+        self.regions = RegionResolver(self.s3.meta.client)
+        self.resources = {self.s3.meta.client.meta.region_name: self.s3}
+        self.resources_lock = threading.Lock()
         self.transfer_config = boto3.s3.transfer.TransferConfig(
             multipart_chunksize = self.CHUNK_SIZE,
             multipart_threshold = self.CHUNK_SIZE
         )
         self.manifest = {}
+        self.etag_cache = etag_cache
+        self.asset_policy = asset_policy
+        self.compressor = Compressor() if asset_policy else None
+        self.controller = controller
+        self.resumable = resumable
+        self.hash_executor = ThreadPoolExecutor(
+            max_workers=os.cpu_count() or 1)
 
     def get_region_name(self, bucket):
         """Get the buckets region name."""
-        bucket_location = self.s3.meta.client.get_bucket_location(
-            Bucket=bucket.name)
-        return bucket_location["LocationConstraint"] or 'us-east-1'
+        return self.regions.lookup(bucket.name)
+
+    def resource_for(self, region_name):
+        """Get the S3 resource for region_name, one per region."""
+        with self.resources_lock:
+            if region_name not in self.resources:
+                self.resources[region_name] = self.session.resource(
+                    's3', region_name=region_name)
+            return self.resources[region_name]
 
     def get_bucket(self, bucket_name):
-        """Get bucket given the bucket name."""
-        return self.s3.Bucket(bucket_name)
+        """Get bucket given the bucket name, bound to its region."""
+        region_name = self.regions.lookup(bucket_name)
+        return self.resource_for(region_name).Bucket(bucket_name)
+
+    def fork(self, asset_policy=None):
+        """Get a BucketManager sharing clients, caches and pools with this one.
+
+        A sync keeps its manifest on the manager, so syncs running
+        concurrently each need their own.
+        """
+        manager = copy.copy(self)
+        manager.manifest = {}
+        manager.asset_policy = asset_policy
+        manager.compressor = Compressor() if asset_policy else None
+        return manager
+
+    def is_website(self, bucket_name):
+        """Check if the bucket exists and is set up as a website."""
+        try:
+            self.get_bucket(bucket_name).Website().load()
+        except ClientError as error:
+            if error.response['Error']['Code'] in (
+                    'NoSuchBucket', 'NoSuchWebsiteConfiguration'):
+                return False
+            raise error
+        return True
 
     def get_bucket_url(self, bucket):
         """Get the website url for this bucket."""
@@ -53,9 +139,17 @@ class BucketManager:
         """Get list of all S3 buckets."""
         return self.s3.buckets.all()
 
+    def bucket_regions(self):
+        """Get a dict of every bucket name to its region.
+
+        Regions not cached yet are looked up concurrently.
+        """
+        return self.regions.lookup_all(
+            bucket.name for bucket in self.all_buckets())
+
     def all_objects(self, bucket_name):
         """Get all objects inside an bucket."""
-        return self.s3.Bucket(bucket_name).objects.all()
+        return self.get_bucket(bucket_name).objects.all()
 
     def init_bucket(self, bucket_name):
         """Create an bucket or if it already exists.
@@ -66,16 +160,22 @@ class BucketManager:
 
         try:
             s3_bucket = self.s3.create_bucket(Bucket=bucket_name)
+            self.regions.remember(bucket_name,
+                                  self.s3.meta.client.meta.region_name)
         except ClientError as error:
             if error.response['Error']['Code'] == 'BucketAlreadyOwnedByYou':
-                s3_bucket = self.s3.Bucket(bucket_name)
+                s3_bucket = self.get_bucket(bucket_name)
             else:
                 raise error
 
         return s3_bucket
 
     def setpolicy(self, bucket):
-        """Set up policy for S3 bucket for it to be public."""
+        """Set up policy for S3 bucket for it to be public.
+
+        Anonymous reads of the .webauto/ prefix, which holds the manifest
+        snapshot, stay denied.
+        """
         policy = """
         {
           "Version":"2012-10-17",
@@ -86,23 +186,156 @@ class BucketManager:
                 "Action":["s3:GetObject"],
                 "Resource":["arn:aws:s3:::%s/*"
               ]
+            },{
+          "Sid":"DenyPublicReadSnapshot",
+                "Effect":"Deny",
+                "Principal": "*",
+                "Action":["s3:GetObject"],
+                "Resource":["arn:aws:s3:::%s/.webauto/*"
+              ],
+                "Condition":{
+                  "StringEquals":{"aws:PrincipalType":"Anonymous"}
+                }
             }
           ]
         }
-        """ % bucket.name
+        """ % (bucket.name, bucket.name)
         policy = policy.strip()
 
         bucketpolicy = bucket.Policy()
         bucketpolicy.put(Policy=policy)
 
-    def load_manifest(self, bucket):
-        """Load manifest for caching purpose."""
-        # print("Loading manifest")
-        paginator = self.s3.meta.client.get_paginator('list_objects_v2')
+    def list_manifest(self, bucket):
+        """List (key, entry) for every object in the bucket in key order."""
+        paginator = bucket.meta.client.get_paginator('list_objects_v2')
         for page in paginator.paginate(Bucket=bucket.name):
             for obj in page.get('Contents', []):
-                self.manifest[obj['Key']] = obj['ETag']
-                # print("{} file and {}".format(obj['Key'], obj['ETag']))
+                if obj['Key'] != self.SNAPSHOT_KEY:
+                    yield obj['Key'], ManifestEntry(obj['ETag'], obj['Size'])
+
+    def fetch_snapshot(self, bucket):
+        """Download and validate the manifest snapshot of the bucket.
+
+        Returns an open temporary file and whether the snapshot is
+        fresh, or (None, False) if there is no valid snapshot.  A
+        snapshot older than SNAPSHOT_MAX_AGE is not fresh, so objects
+        changed without webauto are noticed by the next sync a day later
+        at the latest.
+        """
+        try:
+            head = bucket.meta.client.head_object(
+                Bucket=bucket.name, Key=self.SNAPSHOT_KEY)
+        except ClientError as error:
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None, False
+            raise error
+        age = datetime.now(timezone.utc) - head['LastModified']
+
+        snapshot = tempfile.TemporaryFile()
+        try:
+            bucket.meta.client.download_fileobj(
+                bucket.name, self.SNAPSHOT_KEY, snapshot)
+            snapshot.seek(0)
+            for _ in read_snapshot(bucket.name, snapshot):
+                pass
+        except ClientError as error:
+            snapshot.close()
+            if error.response['Error']['Code'] in ('NoSuchKey', '404'):
+                return None, False
+            raise error
+        except ValueError as error:
+            snapshot.close()
+            print("Ignoring manifest snapshot: {}".format(error))
+            return None, False
+
+        snapshot.seek(0)
+        return snapshot, age <= self.SNAPSHOT_MAX_AGE
+
+    def iter_manifest(self, bucket, full_scan=False):
+        """Get (key, entry) for every object in the bucket in key order.
+
+        The snapshot written by the last sync is used when it is fresh,
+        otherwise (or with full_scan) the whole bucket is listed.  The
+        listing does not hold metadata fingerprints, so they are taken
+        from the snapshot for objects whose ETag it still has.
+        """
+        snapshot, fresh = self.fetch_snapshot(bucket)
+        if snapshot is None:
+            yield from self.list_manifest(bucket)
+            return
+
+        with snapshot:
+            known = ((key, ManifestEntry(etag, size, meta))
+                     for key, etag, size, meta
+                     in read_snapshot(bucket.name, snapshot))
+            if fresh and not full_scan:
+                yield from known
+                return
+
+            if not fresh:
+                print("Manifest snapshot is stale, listing the bucket")
+            for pair in merge_join(self.list_manifest(bucket), known):
+                listed, entry = pair.local, pair.remote
+                if listed is None:
+                    continue
+                if entry is not None and entry.etag == listed.etag:
+                    listed = listed._replace(meta=entry.meta)
+                yield pair.key, listed
+
+    def load_manifest(self, bucket, full_scan=False):
+        """Load manifest for caching purpose."""
+        self.manifest = dict(self.iter_manifest(bucket, full_scan))
+
+    def save_snapshot(self, bucket, entries):
+        """Write (key, entry) pairs, in key order, to the bucket snapshot.
+
+        The snapshot is only uploaded once entries is exhausted, so an
+        error while producing them leaves the previous snapshot alone.
+        """
+        with tempfile.TemporaryFile() as snapshot:
+            writer = SnapshotWriter(bucket.name, snapshot)
+            for key, entry in entries:
+                writer.add(key, entry.etag, entry.size, entry.meta)
+            writer.close()
+
+            snapshot.seek(0)
+            bucket.meta.client.upload_fileobj(
+                snapshot, bucket.name, self.SNAPSHOT_KEY,
+                ExtraArgs={'ContentType': 'application/gzip'})
+
+    def delete_keys(self, bucket, keys):
+        """Delete up to DELETE_BATCH keys from the bucket in one request.
+
+        Returns the set of keys that could not be deleted.
+        """
+        response = bucket.meta.client.delete_objects(
+            Bucket=bucket.name,
+            Delete={'Objects': [{'Key': key} for key in keys],
+                    'Quiet': True})
+        failed = set()
+        for error in response.get('Errors', []):
+            print("Failed to delete {}: {}".format(
+                error['Key'], error['Message']))
+            failed.add(error['Key'])
+        return failed
+
+    def flush_deletes(self, bucket, deletes, dry_run=False):
+        """Delete a batch of (key, entry, future) and resolve the futures.
+
+        A future gets (DELETE, None) once its key is removed, and
+        (FAILED, entry) if it is still in the bucket.
+        """
+        failed = set() if dry_run else \
+            self.delete_keys(bucket, [key for key, _, _ in deletes])
+        for key, entry, future in deletes:
+            future.set_result((FAILED, entry) if key in failed
+                              else (DELETE, None))
+
+    @staticmethod
+    def metadata_fingerprint(extra_args):
+        """Get a short fingerprint of the headers an object is put with."""
+        data = json.dumps(extra_args, sort_keys=True).encode('utf-8')
+        return md5(data).hexdigest()[:16]
 
     @staticmethod
     def hash_data(data):
@@ -112,25 +345,53 @@ class BucketManager:
 
         return hash
 
-    def generate_etag(self, path):
+    def generate_etag(self, path, part_size=None, stat=None):
         """Generate etag for given file."""
-        hashes = []
-
-        with open(path, 'rb') as f:
-            while True:
-                data = f.read(self.CHUNK_SIZE)
-
-                if not data:
-                    break
-
-                hashes.append(self.hash_data(data))
-        if not hashes:
-            return
-        elif len(hashes) == 1:
-            return '"{}"'.format(hashes[0].hexdigest())
-        else:
-            hash = self.hash_data(reduce(lambda x, y: x + y, (h.digest() for h in hashes)))
-            return '"{}-{}"'.format(hash.hexdigest(), len(hashes))
+        part_size = part_size or self.CHUNK_SIZE
+        if self.etag_cache:
+            stat = stat or os.stat(path)
+            etag = self.etag_cache.get(path, part_size, stat)
+            if etag:
+                return etag
+
+        etag = self.compute_etag(path, part_size)
+        if self.etag_cache and etag:
+            self.etag_cache.put(path, part_size, etag, stat)
+        return etag
+
+    def compute_etag(self, path, part_size=None):
+        """Compute etag for given file by reading all of it."""
+        return compute_etag(path, part_size or self.CHUNK_SIZE,
+                            self.hash_executor)
+
+    def etag_matches(self, path, entry, stat=None):
+        """Check if the local file has the same content as manifest entry.
+
+        The remote object may have been uploaded with another part size,
+        so the local etag is recomputed for each part size that gives
+        the same number of parts as the remote etag.
+        """
+        stat = stat or os.stat(path)
+        if entry is None or stat.st_size != entry.size:
+            return False
+
+        one_part = entry.etag.endswith('-1"')
+        for part_size in candidate_part_sizes(entry.etag, entry.size,
+                                              self.CHUNK_SIZE):
+            etag = self.generate_etag(path, part_size, stat)
+            if (as_multipart(etag) if one_part else etag) == entry.etag:
+                return True
+
+        return False
+
+    def uploaded_entry(self, path, stat=None):
+        """Get the manifest entry S3 will report after uploading path."""
+        stat = stat or os.stat(path)
+        part_size = part_size_for(stat.st_size, self.CHUNK_SIZE)
+        etag = self.generate_etag(path, part_size, stat)
+        if stat.st_size >= self.CHUNK_SIZE and etag_parts(etag) == 1:
+            etag = as_multipart(etag)
+        return ManifestEntry(etag, stat.st_size)
 
     def configurewebsite(self, bucket):
         """Set up the bucket to host static website."""
@@ -138,32 +399,450 @@ class BucketManager:
             'ErrorDocument': {'Key': 'error.html'},
             'IndexDocument': {'Suffix': 'index.html'}})
 
-    def upload_file(self, bucket, path, key):
+    def put_file(self, bucket, path, key, extra_args=None):
         """Upload path to S3 bucket to key."""
+        if extra_args is None:
+            content_type = mimetypes.guess_type(key)[0] or 'text/plain'
+            extra_args = {'ContentType': content_type}
+
+        if self.resumable and \
+                os.path.getsize(path) >= self.RESUMABLE_THRESHOLD:
+            upload = ResumableUpload(bucket.meta.client, bucket.name, key,
+                                     path, self.CHUNK_SIZE, extra_args)
+            return self.transfer(upload.upload, upload=True)
+
+        # The client is shared by all sync workers, unlike the resource
+        # objects it is safe to use from multiple threads.
+        return self.transfer(
+            bucket.meta.client.upload_file, path, bucket.name, key,
+            ExtraArgs=extra_args,
+            Config=self.transfer_config, upload=True)
+
+    def transfer(self, func, *args, upload=False, **kwargs):
+        """Run a managed S3 transfer through the controller, if any.
+
+        Only uploads are held to the controller's bandwidth cap; copies
+        and downloads just report their progress.
+        """
+        if self.controller is None:
+            return func(*args, **kwargs)
+        callback = self.controller.upload_callback if upload \
+            else self.controller.callback
+        return self.controller.run(func, *args, Callback=callback, **kwargs)
+
+    def prepare_file(self, local, key):
+        """Get the LocalFile to store at key and its upload arguments.
+
+        With an asset policy, Cache-Control is set from its rules and
+        compressible files are replaced by their compressed copy.
+        """
         content_type = mimetypes.guess_type(key)[0] or 'text/plain'
+        extra_args = {'ContentType': content_type}
+        if self.asset_policy is None:
+            return local, extra_args
+
+        cache_control = self.asset_policy.cache_control(key)
+        if cache_control:
+            extra_args['CacheControl'] = cache_control
+
+        stat = local.stat or os.stat(local.path)
+        encoding = self.asset_policy.encoding_for(content_type, stat.st_size)
+        if encoding:
+            etag = self.generate_etag(local.path, stat=stat)
+            path = self.compressor.compress(local.path, etag, encoding)
+            local = LocalFile(path, os.stat(path))
+            extra_args['ContentEncoding'] = encoding
+
+        return local, extra_args
+
+    def copy_file(self, bucket, source, key, extra_args):
+        """Copy source to key inside the bucket, setting new metadata."""
+        extra_args = dict(extra_args, MetadataDirective='REPLACE')
+        return self.transfer(
+            bucket.meta.client.copy,
+            {'Bucket': bucket.name, 'Key': source}, bucket.name, key,
+            ExtraArgs=extra_args, Config=self.transfer_config)
+
+    def sync_file(self, bucket, local, key, remote, dry_run=False,
+                  content_index=None):
+        """Upload a LocalFile to key unless remote shows it is there.
+
+        With a content_index, content already stored under another key
+        is copied server side instead of being uploaded again.
+
+        Returns the action taken and the manifest entry of key after it.
+        An object with the right content but headers from other asset
+        rules is copied onto itself with the new headers.  Objects whose
+        headers are unknown are taken to have the current ones.
+        """
+        local, extra_args = self.prepare_file(local, key)
+        meta = self.metadata_fingerprint(extra_args)
+        if self.etag_matches(local.path, remote, local.stat):
+            if remote.meta in (None, meta):
+                return SKIP, remote._replace(meta=meta)
+            if dry_run:
+                return COPY, None
+            self.copy_file(bucket, key, key, extra_args)
+            return COPY, self.uploaded_entry(
+                local.path, local.stat)._replace(meta=meta)
+        if dry_run and content_index is None:
+            return UPLOAD, None
+
+        entry = self.uploaded_entry(local.path, local.stat)._replace(
+            meta=meta)
+        if content_index is None or entry.size < self.DEDUP_MIN_SIZE:
+            if dry_run:
+                return UPLOAD, None
+            self.put_file(bucket, local.path, key, extra_args)
+            return UPLOAD, entry
+
+        if dry_run:
+            return (COPY if content_index.source(entry) else UPLOAD), None
+
+        source = content_index.claim(entry)
+        if source is None:
+            try:
+                self.put_file(bucket, local.path, key, extra_args)
+            except BaseException:
+                content_index.release(entry)
+                raise
+            content_index.release(entry, key)
+            return UPLOAD, entry
 
-        etag = self.generate_etag(path)
-        # print("Generated ETAG {} for file {} ".format(etag, key))
-        if self.manifest.get(key, '') == etag:
-            # print("Skipping {} etags match".format(key))
-            return
+        try:
+            self.copy_file(bucket, source, key, extra_args)
+            return COPY, entry
+        except ClientError as error:
+            # The source may have been deleted since it was indexed.
+            if error.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                raise error
 
-        return bucket.upload_file(path, key,
-                                  ExtraArgs={'ContentType': content_type},
-                                  Config=self.transfer_config)
+        self.put_file(bucket, local.path, key, extra_args)
+        return UPLOAD, entry
 
-    def sync(self, pathname, bucket_name):
-        """Sync files in given path to the S3 bucket."""
-        bucket = self.s3.Bucket(bucket_name)
-        self.load_manifest(bucket)
+    def upload_file(self, bucket, path, key):
+        """Upload path to S3 bucket to key if the manifest differs."""
+        action, entry = self.sync_file(bucket, LocalFile(path, None), key,
+                                       self.manifest.get(key))
+        self.manifest[key] = entry
+        return action
+
+    def local_files(self, root, rules=None):
+        """List (key, LocalFile) for every file under root in key order."""
+        for key, local in walk_files(root, rules):
+            if key != self.SNAPSHOT_KEY:
+                yield key, local
+
+    def sync(self, pathname, bucket_name, workers=1, full_scan=False,
+             delete=False, dry_run=False, dedup=False, keep_manifest=False):
+        """Sync files in given path to the S3 bucket.
+
+        The local tree and the bucket manifest are streamed in key order
+        and merge joined, skipping files excluded by the default ignore
+        rules and the tree's .webautoignore.  Files are hashed and
+        uploaded by a pool of `workers` threads, and with `delete`
+        objects missing locally are removed in batches.  After a
+        successful sync the new manifest is saved as a snapshot in the
+        bucket for the next sync to load.
+
+        With `dedup`, the manifest is loaded up front to index objects
+        by content, and files whose content is already in the bucket,
+        or is uploaded earlier in the same sync, are copied server side.
+
+        With `keep_manifest` the new manifest is also kept in memory.
+
+        Returns a SyncResult; with `dry_run` nothing is changed and the
+        result is the plan.
+        """
+        bucket = self.get_bucket(bucket_name)
+        root = Path(pathname).expanduser().resolve()
+        result = SyncResult()
+        self.manifest = {}
+
+        remote = self.iter_manifest(bucket, full_scan)
+        content_index = None
+        if dedup:
+            remote = list(remote)
+            content_index = ContentIndex(remote)
+
+        entries = self.sync_entries(bucket, root, remote, result, workers,
+                                    delete, dry_run, content_index)
+        if keep_manifest:
+            entries = self.remember(entries)
+        if dry_run:
+            for _ in entries:
+                pass
+        else:
+            self.save_snapshot(bucket, entries)
+
+        if self.etag_cache:
+            self.etag_cache.flush()
+
+        return result
+
+    def sync_entries(self, bucket, root, remote, result, workers, delete,
+                     dry_run, content_index=None):
+        """Sync root to bucket, yielding the new manifest in key order.
+
+        Results are yielded in the order the merge join produced them, so
+        at most QUEUE_FACTOR files per worker are held in flight.
+        """
+        max_pending = max(workers, 1) * self.QUEUE_FACTOR
+        window = deque()
+        # Deletes wait in the window, in key order, until their batch is
+        # sent; an object that fails to delete stays in the manifest.
+        deletes = []
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            local = self.local_files(root, IgnoreRules.from_root(root))
+            pairs = merge_join(local, remote)
+            for pair in pairs:
+                if pair.local is not None:
+                    window.append((pair.key, executor.submit(
+                        self.sync_file, bucket, pair.local, pair.key,
+                        pair.remote, dry_run, content_index)))
+                elif not delete:
+                    window.append((pair.key, pair.remote))
+                else:
+                    future = Future()
+                    window.append((pair.key, future))
+                    deletes.append((pair.key, pair.remote, future))
+                    if len(deletes) == self.DELETE_BATCH:
+                        self.flush_deletes(bucket, deletes, dry_run)
+                        deletes = []
+
+                while window:
+                    value = window[0][1]
+                    if isinstance(value, Future) and not value.done():
+                        if len(window) - len(deletes) <= max_pending:
+                            break
+                        if deletes and value is deletes[0][2]:
+                            self.flush_deletes(bucket, deletes, dry_run)
+                            deletes = []
+                    key, value = self.finish_entry(window.popleft(), result)
+                    if value is not None:
+                        yield key, value
+
+            if deletes:
+                self.flush_deletes(bucket, deletes, dry_run)
+            while window:
+                key, value = self.finish_entry(window.popleft(), result)
+                if value is not None:
+                    yield key, value
+
+    def remember(self, entries):
+        """Pass (key, entry) pairs through, storing them in the manifest."""
+        for key, entry in entries:
+            self.manifest[key] = entry
+            yield key, entry
+
+    def sync_changes(self, bucket, changed, removed, workers, delete):
+        """Sync a batch of changed files and removed keys to the bucket.
+
+        Uses and updates the in-memory manifest instead of the bucket's.
+        """
+        result = SyncResult()
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(self.sync_file, bucket, local, key,
+                                       self.manifest.get(key)): key
+                       for key, local in changed.items()}
+            for future in futures:
+                key = futures[future]
+                action, self.manifest[key] = future.result()
+                result.record(action, key)
+
+        deletes = sorted(key for key in removed if key in self.manifest)
+        if delete:
+            failed = set()
+            for start in range(0, len(deletes), self.DELETE_BATCH):
+                failed |= self.delete_keys(
+                    bucket, deletes[start:start + self.DELETE_BATCH])
+            for key in deletes:
+                if key in failed:
+                    result.record(FAILED, key)
+                else:
+                    del self.manifest[key]
+                    result.record(DELETE, key)
+
+        return result
+
+    def watch(self, pathname, bucket_name, workers=1, delete=False,
+              debounce=1.0, on_batch=None):
+        """Sync the path to the S3 bucket every time files change.
+
+        The manifest and a stat index of the tree stay in memory, so each
+        batch of changes costs a re-stat of the paths watchdog reported,
+        or one walk when polling, and the uploads it needs.  The
+        bucket snapshot is removed while watching, so an interrupted
+        watch never leaves a stale one, and written again on exit.
+        on_batch is called with the SyncResult of every batch.
+        """
+        bucket = self.get_bucket(bucket_name)
         root = Path(pathname).expanduser().resolve()
+        index = TreeIndex(root, IgnoreRules.from_root(root))
+        trigger, observer = start_trigger(root)
+
+        bucket.meta.client.delete_object(Bucket=bucket.name,
+                                         Key=self.SNAPSHOT_KEY)
+        try:
+            while True:
+                changed, removed = wait_for_changes(index, debounce,
+                                                    trigger=trigger)
+                result = self.sync_changes(bucket, changed, removed,
+                                           workers, delete)
+                if self.etag_cache:
+                    self.etag_cache.flush()
+                if on_batch:
+                    on_batch(result)
+        finally:
+            if observer:
+                observer.stop()
+            self.save_snapshot(bucket, sorted(self.manifest.items()))
+
+    @staticmethod
+    def finish_entry(item, result):
+        """Wait for a windowed sync item and record its action."""
+        key, value = item
+        if isinstance(value, Future):
+            action, value = value.result()
+            result.record(action, key)
+        else:
+            result.record(KEEP, key)
+        return key, value
+
+    def download_file(self, bucket, key, path, size):
+        """Download key to path, replacing path only once complete.
+
+        Content stored with a gzip or br encoding is decoded.  Objects
+        under CHUNK_SIZE are read with one GET, which also tells their
+        Content-Encoding; larger ones are fetched with concurrent ranged
+        GETs by the managed transfer, after a HEAD for their encoding.
+        """
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=directory, prefix='.webauto-',
+                                    suffix='.tmp')
+        os.close(fd)
+        try:
+            if size < self.CHUNK_SIZE:
+                encoding = self.transfer(self.get_object_to, bucket, key,
+                                         temp)
+            else:
+                encoding = bucket.meta.client.head_object(
+                    Bucket=bucket.name, Key=key).get('ContentEncoding')
+                self.transfer(bucket.meta.client.download_file,
+                              bucket.name, key, temp,
+                              Config=self.transfer_config)
+            if can_decode(encoding):
+                decompress(temp, encoding)
+            elif encoding:
+                print("Cannot decode {} stored as {}, keeping it "
+                      "encoded".format(key, encoding))
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
 
-        def handle_directory(target):
-            for p in target.iterdir():
-                if p.is_dir():
-                    handle_directory(p)
-                if p.is_file():
-                    self.upload_file(bucket, str(p),
-                                     str(p.relative_to(root)))
+    @staticmethod
+    def get_object_to(bucket, key, path, **kwargs):
+        """Write the object at key to path, returning its Content-Encoding.
 
-        handle_directory(root)
+        Takes the Callback of a managed transfer to report progress.
+        """
+        callback = kwargs.get('Callback')
+        response = bucket.meta.client.get_object(Bucket=bucket.name, Key=key)
+        with open(path, 'wb') as out:
+            for chunk in response['Body'].iter_chunks(65536):
+                out.write(chunk)
+                if callback:
+                    callback(len(chunk))
+        return response.get('ContentEncoding')
+
+    def encoded_matches(self, local, key, remote):
+        """Check if the LocalFile, encoded like sync would, matches remote.
+
+        The encoding is predicted from the asset policy, or the default
+        one without, so no request is needed.  Objects compressed by
+        other tools or settings never match and are downloaded again.
+        """
+        policy = self.asset_policy or AssetPolicy()
+        content_type = mimetypes.guess_type(key)[0] or 'text/plain'
+        stat = local.stat or os.stat(local.path)
+        encoding = policy.encoding_for(content_type, stat.st_size)
+        if not can_decode(encoding):
+            return False
+        compressor = self.compressor or Compressor()
+        etag = self.generate_etag(local.path, stat=stat)
+        return self.etag_matches(
+            compressor.compress(local.path, etag, encoding), remote)
+
+    def pull_file(self, bucket, key, root, local, remote, dry_run=False):
+        """Download key under root unless the LocalFile already matches.
+
+        Objects stored with a Content-Encoding are saved decoded, so the
+        local file is also compared with the object after encoding it
+        again.
+        """
+        if local is not None and (
+                self.etag_matches(local.path, remote, local.stat) or
+                self.encoded_matches(local, key, remote)):
+            return SKIP
+        if not dry_run:
+            self.download_file(bucket, key,
+                               os.path.join(root, *key.split('/')),
+                               remote.size)
+        return DOWNLOAD
+
+    def pull(self, bucket_name, pathname, workers=1, full_scan=False,
+             dry_run=False):
+        """Pull objects from the S3 bucket to the given path.
+
+        The bucket manifest and local tree are merge joined like in sync,
+        and only objects whose ETag differs from the local file are
+        downloaded, by a pool of `workers` threads.  Keys that would be
+        ignored by sync, or could escape the folder, are skipped.
+
+        Returns a SyncResult; with `dry_run` nothing is changed and the
+        result is the plan.
+        """
+        bucket = self.get_bucket(bucket_name)
+        root = Path(pathname).expanduser().resolve()
+        os.makedirs(str(root), exist_ok=True)
+        rules = IgnoreRules.from_root(root)
+        result = SyncResult()
+
+        remote = ((key, entry) for key, entry
+                  in self.iter_manifest(bucket, full_scan)
+                  if self.pullable(key) and not rules.ignored_key(key))
+        pairs = merge_join(self.local_files(root, rules), remote)
+
+        max_pending = max(workers, 1) * self.QUEUE_FACTOR
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            pending = {}
+            for pair in pairs:
+                if pair.remote is None:
+                    continue
+                if len(pending) >= max_pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result.record(future.result(), pending.pop(future))
+                future = executor.submit(
+                    self.pull_file, bucket, pair.key, str(root), pair.local,
+                    pair.remote, dry_run)
+                pending[future] = pair.key
+
+            for future in wait(pending).done:
+                result.record(future.result(), pending[future])
+
+        if self.etag_cache:
+            self.etag_cache.flush()
+
+        return result
+
+    @staticmethod
+    def pullable(key):
+        """Check if key can be written as a file under the pull folder."""
+        parts = key.split('/')
+        return bool(parts[-1]) and not key.startswith('/') and \
+            not any(part in ('', '.', '..') for part in parts)
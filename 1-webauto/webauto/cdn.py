@@ -1,29 +1,154 @@
 """Class for cloud front distribution."""
 
 import uuid
+from bisect import bisect_left
+from urllib.parse import quote
+
+from botocore.exceptions import ClientError
+
+from webauto import util
+from webauto.ttlcache import TTLCache
+from webauto.waiter import DeployWaiter
 
 
 class DistributionManager:
-    """Manage an cloud front distribution for given domain."""
+    """Manage an cloud front distribution for given domain.
+
+    Distributions are looked up in an index of their aliases, built from
+    one listing and cached locally for TTL seconds.  Matches from the
+    cached index are checked against the distribution before they are
+    used, and the index is listed again if one is stale or a domain is
+    missing.
+    """
 
-    def __init__(self, session):
+    MAX_PATHS = 3000
+    MAX_WILDCARDS = 15
+    COLLAPSE_THRESHOLD = 10
+    TTL = 10 * 60
+
+    def __init__(self, session, cache=True):
         """Create DistributionManager object."""
         self.session = session
         self.client = self.session.client('cloudfront')
+        self.cache = TTLCache('distributions', self.TTL) if cache else None
+        self.account_key = None
+        self.dists = None
+        self.aliases = None
+        self.dists_listed = False
+        self.waiter = DeployWaiter(on_progress=print)
 
-    def find_matching_dist(self, domain_name):
-        """Find an matching distribution for given domain_name."""
+    @property
+    def cache_key(self):
+        """Get the key of the distributions in the local cache."""
+        if self.account_key is None:
+            self.account_key = util.account_key(self.session)
+        return self.account_key
+
+    @staticmethod
+    def summary(dist):
+        """Get the parts of a distribution webauto uses, as plain JSON."""
+        aliases = dist.get('Aliases') or \
+            dist.get('DistributionConfig', {}).get('Aliases', {})
+        items = aliases.get('Items', [])
+        return {
+            'Id': dist['Id'],
+            'ARN': dist['ARN'],
+            'DomainName': dist['DomainName'],
+            'Aliases': {'Quantity': len(items), 'Items': items}
+        }
+
+    def list_dists(self):
+        """List the summaries of all distributions."""
         paginator = self.client.get_paginator('list_distributions')
         for page in paginator.paginate():
             for dist in page['DistributionList'].get('Items', []):
-                for alias in dist['Aliases']['Items']:
-                    if alias == domain_name:
-                        return dist
+                yield self.summary(dist)
+
+    def load_dists(self, refresh=False):
+        """Load the alias index, from the cache unless refresh is given."""
+        dists = None
+        if self.cache is not None and not refresh:
+            dists = self.cache.get(self.cache_key)
+        if dists is None:
+            dists = list(self.list_dists())
+            self.dists_listed = True
+        self.dists = []
+        self.aliases = {}
+        for dist in dists:
+            self.add_dist(dist)
+        self.save_dists()
+
+    def add_dist(self, dist):
+        """Add a distribution summary to the alias index."""
+        self.dists.append(dist)
+        for alias in dist['Aliases']['Items']:
+            self.aliases.setdefault(alias.lower(), dist)
+
+    def save_dists(self):
+        """Write the loaded distributions to the local cache."""
+        if self.cache is not None:
+            self.cache.put(self.cache_key, self.dists)
+            self.cache.flush()
+
+    @staticmethod
+    def alias_names(domain_name):
+        """Get the aliases that would serve domain_name, exact one first."""
+        domain_name = domain_name.lower().rstrip('.')
+        parent = domain_name.partition('.')[2]
+        return [domain_name, '*.' + parent] if parent else [domain_name]
+
+    def lookup(self, domain_name):
+        """Get the distribution serving domain_name from the index."""
+        if self.aliases is None:
+            self.load_dists()
+        for alias in self.alias_names(domain_name):
+            if alias in self.aliases:
+                return self.aliases[alias]
         return None
 
-    def create_dist(self, domain_name, cert):
-        """Create a distribution for given domain using certificate."""
-        orgin_id = 'S3-' + domain_name
+    def still_serves(self, dist_id, domain_names):
+        """Check the distribution still has aliases for all domain_names."""
+        try:
+            dist = self.client.get_distribution(Id=dist_id)['Distribution']
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchDistribution':
+                return False
+            raise error
+        aliases = {alias.lower() for alias in self.summary(dist)[
+            'Aliases']['Items']}
+        return all(aliases.intersection(self.alias_names(domain_name))
+                   for domain_name in domain_names)
+
+    def cached_matches_valid(self, matches):
+        """Check matches made with the cached index, one call per dist."""
+        served = {}
+        for domain_name, dist in matches.items():
+            if dist is None:
+                return False
+            served.setdefault(dist['Id'], []).append(domain_name)
+        return all(self.still_serves(dist_id, domain_names)
+                   for dist_id, domain_names in served.items())
+
+    def find_matching_dists(self, domain_names):
+        """Get a dict of every domain name to its distribution or None."""
+        matches = {name: self.lookup(name) for name in domain_names}
+        if not self.dists_listed and not self.cached_matches_valid(matches):
+            self.load_dists(refresh=True)
+            matches = {name: self.lookup(name) for name in domain_names}
+        return matches
+
+    def find_matching_dist(self, domain_name):
+        """Find an matching distribution for given domain_name."""
+        return self.find_matching_dists([domain_name])[domain_name]
+
+    def create_dist(self, domain_name, cert, bucket_name=None):
+        """Create a distribution for given domain using certificate.
+
+        Its origin is the bucket named bucket_name, by default the bucket
+        named like the domain.
+        """
+        bucket_name = bucket_name or domain_name
+        orgin_id = 'S3-' + bucket_name
 
         result = self.client.create_distribution(
             DistributionConfig={
@@ -40,7 +165,7 @@ class DistributionManager:
                     'Items': [{
                         'Id': orgin_id,
                         'DomainName':
-                        '{}.s3.amazonaws.com'.format(domain_name),
+                        '{}.s3.amazonaws.com'.format(bucket_name),
                         'S3OriginConfig': {
                             'OriginAccessIdentity': ''
                         }
@@ -69,12 +194,105 @@ class DistributionManager:
             }
         }
         )
+        if self.aliases is None:
+            self.load_dists()
+        self.add_dist(self.summary(result['Distribution']))
+        self.save_dists()
         return result['Distribution']
 
+    def is_deployed(self, dist_id):
+        """Check if the distribution is deployed."""
+        dist = self.client.get_distribution(Id=dist_id)['Distribution']
+        return dist['Status'] == 'Deployed'
+
+    def track_deploy(self, dist):
+        """Get a Future done when the distribution is deployed."""
+        return self.waiter.track(
+            'Distribution {}'.format(dist['Id']),
+            lambda: self.is_deployed(dist['Id']))
+
+    def track_invalidation(self, dist, invalidation):
+        """Get a Future done when the invalidation is completed."""
+        def completed():
+            result = self.client.get_invalidation(
+                DistributionId=dist['Id'], Id=invalidation['Id'])
+            return result['Invalidation']['Status'] == 'Completed'
+
+        return self.waiter.track(
+            'Invalidation {}'.format(invalidation['Id']), completed)
+
     def await_deploy(self, dist):
         """Await for CDN deployment to complete after creation before use."""
-        waiter = self.client.get_waiter('distribution_deployed')
-        waiter.wait(Id=dist['Id'], WaiterConfig={
-                        'Delay': 30,
-                        'MaxAttempts': 50
-                    })
+        self.track_deploy(dist).result()
+
+    @classmethod
+    def invalidation_paths(cls, keys):
+        """Build a small list of invalidation paths covering the keys.
+
+        Directories other than the root with COLLAPSE_THRESHOLD or more
+        changed paths are replaced by a wildcard, deepest first, using at
+        most MAX_WILDCARDS wildcards.  If the paths still exceed MAX_PATHS,
+        the directories covering the most paths are collapsed too, and
+        as a last resort the whole distribution is invalidated.
+        """
+        paths = set()
+        for key in keys:
+            path = '/' + quote(key)
+            paths.add(path)
+            if key == 'index.html' or key.endswith('/index.html'):
+                paths.add(path[:-len('index.html')])
+
+        dirs = set()
+        for path in paths:
+            parts = path.split('/')[1:-1]
+            for depth in range(len(parts) + 1):
+                dirs.add('/' + ''.join(p + '/' for p in parts[:depth]))
+
+        def covered(ordered, directory):
+            """Count the paths in sorted list ordered under directory."""
+            return bisect_left(ordered, directory + '\uffff') - \
+                bisect_left(ordered, directory)
+
+        wildcards = 0
+        dirs.discard('/')
+        ordered = sorted(paths)
+        for directory in sorted(dirs, key=lambda d: d.count('/'),
+                                reverse=True):
+            if wildcards < cls.MAX_WILDCARDS and \
+                    covered(ordered, directory) >= cls.COLLAPSE_THRESHOLD:
+                paths = cls.collapse(paths, directory)
+                ordered = sorted(paths)
+                wildcards += 1
+
+        while len(paths) > cls.MAX_PATHS and dirs and \
+                wildcards < cls.MAX_WILDCARDS:
+            ordered = sorted(paths)
+            directory = max(dirs, key=lambda d: (covered(ordered, d),
+                                                 d.count('/')))
+            paths = cls.collapse(paths, directory)
+            dirs.discard(directory)
+            wildcards += 1
+
+        if len(paths) > cls.MAX_PATHS:
+            return ['/*']
+        return sorted(paths)
+
+    @staticmethod
+    def collapse(paths, directory):
+        """Replace all paths under directory with a wildcard."""
+        return {p for p in paths if not p.startswith(directory)} | \
+            {directory + '*'}
+
+    def invalidate(self, dist, keys):
+        """Invalidate the cached copies of keys in the distribution."""
+        paths = self.invalidation_paths(keys)
+        result = self.client.create_invalidation(
+            DistributionId=dist['Id'],
+            InvalidationBatch={
+                'Paths': {
+                    'Quantity': len(paths),
+                    'Items': paths
+                },
+                'CallerReference': str(uuid.uuid4())
+            })
+        return result['Invalidation']
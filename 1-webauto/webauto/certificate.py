@@ -1,33 +1,111 @@
 # -*- coding : utf-8 -*-
 """Class for ACM Az Certificate Manager."""
 
+from concurrent.futures import ThreadPoolExecutor
+
+from webauto.ttlcache import TTLCache
+
 
 class CertificateManager:
-    """Manager Certificates in Az for website registered."""
+    """Manager Certificates in Az for website registered.
+
+    The names of every issued certificate are indexed once per run, from
+    the list_certificates summaries where they are complete and from
+    describe_certificate, run concurrently, where they are not.  The
+    names of a certificate never change, so described ones are cached
+    locally by ARN.
+    """
+
+    TTL = 7 * 24 * 3600
+    WORKERS = 8
 
     def __init__(self, session):
         """Create CertificateManager object."""
         self.session = session
         self.client = self.session.client('acm')
+        self.alt_names = TTLCache('certificates', self.TTL)
+        self.index = None
+
+    @staticmethod
+    def name_matches(name, domain_name):
+        """Check if a certificate name, possibly a wildcard, covers domain.
+
+        A wildcard covers exactly one label, like browsers check it.
+        """
+        name = name.lower()
+        domain_name = domain_name.lower().rstrip('.')
+        if name == domain_name:
+            return True
+        parent = domain_name.partition('.')[2]
+        return name.startswith('*.') and name[2:] == parent
+
+    def get_alt_names(self, cert_arn):
+        """Get the subject alternative names of a certificate."""
+        alt_names = self.alt_names.get(cert_arn)
+        if alt_names is None:
+            cert_details = self.client.describe_certificate(
+                CertificateArn=cert_arn)
+            alt_names = cert_details['Certificate']['SubjectAlternativeNames']
+            self.alt_names.put(cert_arn, alt_names)
+        return alt_names
 
     def cert_matches(self, cert_arn, domain_name):
         """Check if the given certificate mathces for given domain."""
-        cert_details = self.client.describe_certificate(CertificateArn=cert_arn)
-        alt_names = cert_details['Certificate']['SubjectAlternativeNames']
-        for name in alt_names:
-            if name == domain_name:
-                return True
-            if name[0] == '*' and domain_name.endswith(name[1:]):
-                return True
+        return any(self.name_matches(name, domain_name)
+                   for name in self.get_alt_names(cert_arn))
 
-        return False
+    @staticmethod
+    def summary_names(cert):
+        """Get the names in a certificate summary, or None if incomplete."""
+        if 'SubjectAlternativeNameSummaries' not in cert or \
+                cert.get('HasAdditionalSubjectAlternativeNames'):
+            return None
+        return [cert['DomainName']] + cert['SubjectAlternativeNameSummaries']
 
-    def find_matching_cert(self, domain_name):
-        """Find a certificate for given domain or sub domain."""
+    def issued_certs(self):
+        """Get the summaries of all issued certificates."""
         paginator = self.client.get_paginator('list_certificates')
         for page in paginator.paginate(CertificateStatuses=['ISSUED']):
-            for cert in page['CertificateSummaryList']:
-                if self.cert_matches(cert['CertificateArn'], domain_name):
-                    return cert
+            yield from page['CertificateSummaryList']
+
+    def build_index(self):
+        """Map every certificate name to [(position, cert summary)]."""
+        certs = list(self.issued_certs())
+        names = [self.summary_names(cert) for cert in certs]
+        missing = [cert['CertificateArn']
+                   for cert, cert_names in zip(certs, names)
+                   if cert_names is None]
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            described = dict(zip(missing,
+                                 executor.map(self.get_alt_names, missing)))
+        self.alt_names.flush()
+
+        index = {}
+        for position, (cert, cert_names) in enumerate(zip(certs, names)):
+            if cert_names is None:
+                cert_names = described[cert['CertificateArn']]
+            for name in {name.lower() for name in cert_names}:
+                index.setdefault(name, []).append((position, cert))
+        return index
+
+    def find_matching_cert(self, domain_name):
+        """Find a certificate for given domain or sub domain.
+
+        When several match, the first one listed by ACM is returned.
+        """
+        if self.index is None:
+            self.index = self.build_index()
+
+        domain_name = domain_name.lower().rstrip('.')
+        matches = list(self.index.get(domain_name, []))
+        parent = domain_name.partition('.')[2]
+        if parent:
+            matches += self.index.get('*.' + parent, [])
+        if not matches:
+            return None
+        return min(matches, key=lambda match: match[0])[1]
 
-        return None
+    def find_matching_certs(self, domain_names):
+        """Get a dict of every domain name to its certificate or None."""
+        return {domain_name: self.find_matching_cert(domain_name)
+                for domain_name in domain_names}
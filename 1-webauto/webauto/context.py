@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Class AWSContext shared by the webauto commands.
+
+The boto3 session, clients, resources and managers are only created,
+and their modules only imported, the first time a command uses them.
+"""
+
+import importlib
+import threading
+
+MANAGERS = {
+    'bucket_manager': ('webauto.bucket', 'BucketManager'),
+    'domain_manager': ('webauto.domain', 'DomainManager'),
+    'cert_manager': ('webauto.certificate', 'CertificateManager'),
+    'dist_manager': ('webauto.cdn', 'DistributionManager'),
+}
+
+
+class AWSContext:
+    """Lazily create and cache the AWS objects of a webauto run.
+
+    It can be passed to the managers in place of a boto3 session, so all
+    managers share the same clients and botocore configuration.
+    """
+
+    MAX_POOL_CONNECTIONS = 64
+    MAX_ATTEMPTS = 10
+
+    def __init__(self, profile=None):
+        """Create AWSContext using the given AWS profile."""
+        self.profile = profile
+        self.lock = threading.RLock()
+        self.cache = {}
+
+    def cached(self, key, create):
+        """Get the object cached under key, creating it on first use."""
+        with self.lock:
+            if key not in self.cache:
+                self.cache[key] = create()
+            return self.cache[key]
+
+    @property
+    def session(self):
+        """Get the boto3 session."""
+        def create():
+            import boto3
+            session_cfg = {}
+            if self.profile:
+                session_cfg['profile_name'] = self.profile
+            return boto3.Session(**session_cfg)
+
+        return self.cached('session', create)
+
+    @property
+    def profile_name(self):
+        """Get the name of the AWS profile in use."""
+        return self.session.profile_name
+
+    def get_credentials(self):
+        """Get the credentials of the session."""
+        return self.session.get_credentials()
+
+    @property
+    def config(self):
+        """Get the botocore config shared by all clients."""
+        def create():
+            from botocore.config import Config
+            return Config(
+                max_pool_connections=self.MAX_POOL_CONNECTIONS,
+                retries={'max_attempts': self.MAX_ATTEMPTS,
+                         'mode': 'standard'})
+
+        return self.cached('config', create)
+
+    def client(self, service_name, region_name=None):
+        """Get a client for service_name, optionally in region_name."""
+        return self.cached(
+            ('client', service_name, region_name),
+            lambda: self.session.client(service_name,
+                                        region_name=region_name,
+                                        config=self.config))
+
+    def resource(self, service_name, region_name=None):
+        """Get a resource for service_name, optionally in region_name."""
+        return self.cached(
+            ('resource', service_name, region_name),
+            lambda: self.session.resource(service_name,
+                                          region_name=region_name,
+                                          config=self.config))
+
+    def __getattr__(self, name):
+        """Get a manager, such as bucket_manager, on first use."""
+        if name not in MANAGERS:
+            raise AttributeError(name)
+
+        def create():
+            module_name, class_name = MANAGERS[name]
+            module = importlib.import_module(module_name)
+            return getattr(module, class_name)(self)
+
+        return self.cached(name, create)
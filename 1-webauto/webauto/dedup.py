@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""Class ContentIndex to find objects that already hold some content."""
+
+import threading
+
+
+class ContentIndex:
+    """Map manifest entries (etag, size) to a key holding that content.
+
+    Workers claim content before uploading it, so when several files
+    in one sync share the same content only the first is uploaded and
+    the others wait to copy it.
+    """
+
+    def __init__(self, manifest=()):
+        """Create ContentIndex from (key, entry) pairs."""
+        self.keys = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        for key, entry in manifest:
+            self.keys.setdefault((entry.etag, entry.size), key)
+
+    def source(self, entry):
+        """Get a key already holding the content of entry, if any."""
+        with self.lock:
+            return self.keys.get((entry.etag, entry.size))
+
+    def claim(self, entry):
+        """Get a key to copy entry's content from.
+
+        Returns None when the caller should upload the content itself,
+        in which case it must call release once done.  Waits while
+        another worker is uploading the same content.
+        """
+        content = (entry.etag, entry.size)
+        while True:
+            with self.lock:
+                if content in self.keys:
+                    return self.keys[content]
+                uploading = self.pending.get(content)
+                if uploading is None:
+                    self.pending[content] = threading.Event()
+                    return None
+            uploading.wait()
+
+    def release(self, entry, key=None):
+        """Finish a claim, recording key as holding the content."""
+        content = (entry.etag, entry.size)
+        with self.lock:
+            uploading = self.pending.pop(content)
+            if key is not None:
+                self.keys[content] = key
+        uploading.set()
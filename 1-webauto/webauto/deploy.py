@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""
+Deploy many sites at once from a sites file.
+
+    - Every site is a small graph of steps: bucket, sync, certificate,
+      distribution, invalidation and DNS record
+    - The steps of all sites run concurrently as soon as the steps they
+      depend on succeeded, under per service API rate limits
+    - Steps whose target already matches change nothing
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from webauto import util
+from webauto.assets import AssetPolicy
+from webauto.transfer import TokenBucket
+
+# Steps started per second for each AWS service.
+API_RATES = {'s3': 20, 'acm': 10, 'cloudfront': 5, 'route53': 5}
+
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def load_sites(path):
+    """Load the sites of a JSON sites file.
+
+    Relative site paths are taken from the sites file's directory.
+    Raises ValueError if a site lacks a domain or path, or if a site
+    without a CDN names a bucket other than its domain, which the S3
+    website endpoint could not serve under the domain.
+    """
+    with open(path) as f:
+        config = json.load(f)
+
+    base = os.path.dirname(os.path.abspath(path))
+    sites = config.get('sites', [])
+    for site in sites:
+        if 'domain' not in site or 'path' not in site:
+            raise ValueError('Every site needs a domain and a path')
+        if not site.get('cdn') and \
+                site.get('bucket', site['domain']) != site['domain']:
+            raise ValueError('{} needs cdn to be served from bucket {}'
+                             .format(site['domain'], site['bucket']))
+        site['path'] = os.path.join(base, os.path.expanduser(site['path']))
+        if site.get('assets_config'):
+            site['assets_config'] = os.path.join(base, site['assets_config'])
+    return sites
+
+
+class Step:
+    """A unit of deploy work, run once the steps it depends on succeed.
+
+    func returns (DONE or SKIPPED, message) or raises.
+    """
+
+    def __init__(self, name, service, func, deps=()):
+        """Create Step calling func, rate limited as a service call."""
+        self.name = name
+        self.service = service
+        self.func = func
+        self.deps = list(deps)
+
+
+class Scheduler:
+    """Run a graph of steps concurrently.
+
+    The rates limit how many steps of a service start per second, not
+    the API calls made by a step: a step making several calls relies on
+    the clients' retries when AWS throttles it.
+    """
+
+    def __init__(self, workers=16, rates=None):
+        """Create Scheduler running up to workers steps at once."""
+        self.workers = workers
+        self.limits = {service: TokenBucket(rate) for service, rate
+                       in (rates or API_RATES).items()}
+
+    def call(self, step):
+        """Run a step once its service's rate allows it to start."""
+        if step.service in self.limits:
+            self.limits[step.service].consume()
+        return step.func()
+
+    def run(self, steps, on_finish=None):
+        """Run all steps and get {name: (outcome, message)}.
+
+        A step whose dependency failed fails without running.  on_finish
+        is called with every step and its outcome.
+        """
+        names = {step.name for step in steps}
+        for step in steps:
+            unknown = set(step.deps) - names
+            if unknown:
+                raise ValueError('{} depends on unknown {}'.format(
+                    step.name, ', '.join(sorted(unknown))))
+
+        results = {}
+        waiting = list(steps)
+        running = {}
+
+        def finish(step, outcome):
+            results[step.name] = outcome
+            if on_finish:
+                on_finish(step, outcome)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while waiting or running:
+                progress = True
+                while progress:
+                    progress = False
+                    for step in list(waiting):
+                        deps = [results.get(dep) for dep in step.deps]
+                        if None in deps:
+                            continue
+                        waiting.remove(step)
+                        progress = True
+                        if any(dep[0] == FAILED for dep in deps):
+                            finish(step, (FAILED, 'a dependency failed'))
+                        else:
+                            running[executor.submit(self.call, step)] = step
+
+                if not running:
+                    if waiting:
+                        raise ValueError('Steps depend on each other: ' +
+                                         ', '.join(s.name for s in waiting))
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    try:
+                        outcome = future.result()
+                    except Exception as error:
+                        outcome = (FAILED, str(error))
+                    finish(step, outcome)
+
+        return results
+
+
+class Site:
+    """The deploy steps of one site and the state they share."""
+
+    def __init__(self, aws, config, bucket_manager, workers):
+        """Create Site from its sites file entry."""
+        self.aws = aws
+        self.domain = config['domain']
+        self.path = config['path']
+        self.bucket_name = config.get('bucket', self.domain)
+        self.cdn = config.get('cdn', False)
+        self.delete = config.get('delete', False)
+        self.workers = workers
+        asset_policy = None
+        if config.get('assets_config'):
+            asset_policy = AssetPolicy.from_file(config['assets_config'])
+        self.bucket_manager = bucket_manager.fork(asset_policy)
+        self.cert = None
+        self.dist = None
+        self.dist_created = False
+        self.deployed = None
+        self.result = None
+
+    def step_name(self, step):
+        """Get the name of one of the site's steps."""
+        return '{}:{}'.format(self.domain, step)
+
+    def steps(self):
+        """Get the steps deploying the site."""
+        name = self.step_name
+        steps = [
+            Step(name('bucket'), 's3', self.setup_bucket),
+            Step(name('sync'), 's3', self.sync, [name('bucket')]),
+        ]
+        if self.cdn:
+            steps += [
+                Step(name('cert'), 'acm', self.find_cert),
+                Step(name('dist'), 'cloudfront', self.setup_dist,
+                     [name('bucket'), name('cert')]),
+                Step(name('invalidate'), 'cloudfront', self.invalidate,
+                     [name('sync'), name('dist')]),
+                Step(name('dns'), 'route53', self.setup_record,
+                     [name('dist')]),
+            ]
+        else:
+            steps.append(Step(name('dns'), 'route53', self.setup_record,
+                              [name('bucket')]))
+        return steps
+
+    def setup_bucket(self):
+        """Create and configure the website bucket unless it exists."""
+        if self.bucket_manager.is_website(self.bucket_name):
+            return SKIPPED, 'bucket is a website'
+        bucket = self.bucket_manager.init_bucket(self.bucket_name)
+        self.bucket_manager.setpolicy(bucket)
+        self.bucket_manager.configurewebsite(bucket)
+        return DONE, 'bucket configured'
+
+    def sync(self):
+        """Sync the site's folder to its bucket."""
+        self.result = self.bucket_manager.sync(
+            self.path, self.bucket_name, workers=self.workers,
+            delete=self.delete)
+        if self.result.changed:
+            return DONE, str(self.result)
+        return SKIPPED, str(self.result)
+
+    def find_cert(self):
+        """Find the certificate of the site's domain."""
+        self.cert = self.aws.cert_manager.find_matching_cert(self.domain)
+        if not self.cert:
+            raise ValueError('No matching certificate')
+        return DONE, self.cert['CertificateArn']
+
+    def setup_dist(self):
+        """Create the site's distribution unless it exists."""
+        dist_manager = self.aws.dist_manager
+        self.dist = dist_manager.find_matching_dist(self.domain)
+        if self.dist:
+            return SKIPPED, 'distribution {}'.format(self.dist['Id'])
+        self.dist = dist_manager.create_dist(self.domain, self.cert,
+                                             self.bucket_name)
+        self.dist_created = True
+        self.deployed = dist_manager.track_deploy(self.dist)
+        return DONE, 'distribution {} created'.format(self.dist['Id'])
+
+    def invalidate(self):
+        """Invalidate the changed files in an existing distribution."""
+        if self.dist_created or not self.result.changed:
+            return SKIPPED, 'nothing cached is stale'
+        invalidation = self.aws.dist_manager.invalidate(
+            self.dist, self.result.changed)
+        return DONE, 'invalidation {}'.format(invalidation['Id'])
+
+    def setup_record(self):
+        """Point the domain to the distribution, or to the bucket."""
+        domain_manager = self.aws.domain_manager
+        if self.cdn:
+            record_set = domain_manager.alias_record(
+                self.domain, domain_manager.CLOUDFRONT_ZONE,
+                self.dist['DomainName'])
+        else:
+            region_name = self.bucket_manager.regions.lookup(
+                self.bucket_name)
+            endpoint = util.get_endpoint(region_name)
+            record_set = domain_manager.alias_record(
+                self.domain, endpoint.zone, endpoint.host)
+
+        zone = domain_manager.ensure_hostedzone(self.domain)
+        if domain_manager.record_matches(zone, record_set):
+            return SKIPPED, 'record is up to date'
+        domain_manager.change_records(zone, [record_set])
+        return DONE, 'record written'
+
+
+class Deployment:
+    """Deploy many sites with one Scheduler."""
+
+    def __init__(self, aws, sites, workers=16, sync_workers=10):
+        """Create Deployment of the sites loaded from a sites file."""
+        self.aws = aws
+        self.sites = [Site(aws, config, aws.bucket_manager, sync_workers)
+                      for config in sites]
+        self.scheduler = Scheduler(workers)
+
+    def prepare(self):
+        """Load the certificate, distribution and zone indexes up front.
+
+        Each is then a few API calls for all sites, and the steps only
+        read the loaded indexes.
+        """
+        cdn_domains = [site.domain for site in self.sites if site.cdn]
+        if cdn_domains:
+            self.aws.cert_manager.find_matching_certs(cdn_domains)
+            self.aws.dist_manager.find_matching_dists(cdn_domains)
+        self.aws.domain_manager.find_hostedzones(
+            [site.domain for site in self.sites])
+
+    def run(self, on_finish=None):
+        """Deploy all sites and wait for new distributions to deploy.
+
+        Returns {step name: (outcome, message)}, where the wait for a
+        site's new distribution is the <domain>:deployed step.
+        """
+        self.prepare()
+        steps = [step for site in self.sites for step in site.steps()]
+        results = self.scheduler.run(steps, on_finish)
+
+        deploys = {site.deployed: site for site in self.sites
+                   if site.deployed}
+        if deploys:
+            print("Awaiting {} distribution deployments".format(
+                len(deploys)))
+            for future in wait(deploys).done:
+                site = deploys[future]
+                step = Step(site.step_name('deployed'), 'cloudfront', None,
+                            [site.step_name('dist')])
+                error = future.exception()
+                outcome = (FAILED, str(error)) if error \
+                    else (DONE, 'distribution deployed')
+                results[step.name] = outcome
+                if on_finish:
+                    on_finish(step, outcome)
+        return results
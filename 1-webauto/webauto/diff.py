@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+Diff a local tree against a bucket listing.
+
+Both sides are streamed in key order and merge joined, so memory does
+not grow with the number of objects in the bucket.
+"""
+
+from collections import namedtuple
+
+UPLOAD = 'upload'
+DOWNLOAD = 'download'
+COPY = 'copy'
+SKIP = 'skip'
+DELETE = 'delete'
+KEEP = 'keep'
+FAILED = 'failed'
+
+Pair = namedtuple('Pair', ['key', 'local', 'remote'])
+
+
+def merge_join(local, remote):
+    """Join sorted (key, local) and (key, remote) streams on key.
+
+    Yields a Pair for every key on either side, with local or remote set
+    to None when the key only exists on the other side.  S3 lists keys
+    in UTF-8 byte order, which is the same as Python's str ordering.
+    """
+    local = iter(local)
+    remote = iter(remote)
+    local_item = next(local, None)
+    remote_item = next(remote, None)
+
+    while local_item is not None or remote_item is not None:
+        if remote_item is None or \
+                (local_item is not None and local_item[0] < remote_item[0]):
+            yield Pair(local_item[0], local_item[1], None)
+            local_item = next(local, None)
+        elif local_item is None or remote_item[0] < local_item[0]:
+            yield Pair(remote_item[0], None, remote_item[1])
+            remote_item = next(remote, None)
+        else:
+            yield Pair(local_item[0], local_item[1], remote_item[1])
+            local_item = next(local, None)
+            remote_item = next(remote, None)
+
+
+class SyncResult:
+    """Keys changed by a sync, or that would be changed in a dry run."""
+
+    def __init__(self):
+        """Create an empty SyncResult."""
+        self.uploaded = []
+        self.downloaded = []
+        self.copied = []
+        self.deleted = []
+        self.failed = []
+        self.skipped = 0
+
+    def record(self, action, key):
+        """Record the action taken for key."""
+        if action == UPLOAD:
+            self.uploaded.append(key)
+        elif action == DOWNLOAD:
+            self.downloaded.append(key)
+        elif action == COPY:
+            self.copied.append(key)
+        elif action == DELETE:
+            self.deleted.append(key)
+        elif action == FAILED:
+            self.failed.append(key)
+        elif action == SKIP:
+            self.skipped += 1
+
+    @property
+    def changed(self):
+        """Get all keys whose content changed on the bucket."""
+        return self.uploaded + self.copied + self.deleted
+
+    def __str__(self):
+        """Summarize the result."""
+        counts = [(len(self.uploaded), 'uploaded'),
+                  (len(self.downloaded), 'downloaded'),
+                  (len(self.copied), 'copied'),
+                  (len(self.deleted), 'deleted'),
+                  (len(self.failed), 'failed'),
+                  (self.skipped, 'unchanged')]
+        return ', '.join('{} {}'.format(count, label)
+                         for count, label in counts if count) or 'no files'
@@ -1,36 +1,192 @@
 # -*- coding : utf-8 -*-
 """Class for Route53 domains."""
 
+import threading
 import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from webauto import util
+from webauto.ttlcache import TTLCache
+from webauto.zones import ZoneTrie, labels
 
 
 class DomainManager:
-    """Manage an Route53 Domain bucket."""
+    """Manage an Route53 Domain bucket.
+
+    The public hosted zones are listed once per run into a ZoneTrie.
+    When listing them takes more than one request, the trie is also
+    cached locally for TTL seconds, and zones found in a cached trie are
+    checked with one request per zone; the zones are listed again if
+    one was deleted or a nested one was created.
+    """
 
-    def __init__(self, session):
+    TTL = 15 * 60
+    CLOUDFRONT_ZONE = 'Z2FDTNDATAQYW2'
+    MAX_BATCH_RECORDS = 1000
+    MAX_BATCH_SIZE = 32000
+    LIST_PAGE_SIZE = 100
+    WORKERS = 4
+
+    def __init__(self, session, cache=True):
         """Create DomainManager object."""
         self.session = session
         self.client = self.session.client('route53')
+        self.cache = TTLCache('hostedzones', self.TTL) if cache else None
+        self.account_key = None
+        self.zones = None
+        self.zones_listed = False
+        self.checked = set()
+        self.lock = threading.Lock()
 
-    def find_hostedzone(self, domain_name):
-        """Find a hosted zone for the given domain name."""
+    @property
+    def cache_key(self):
+        """Get the key of the zones in the local cache."""
+        if self.account_key is None:
+            self.account_key = util.account_key(self.session)
+        return self.account_key
+
+    @staticmethod
+    def is_public(zone):
+        """Check if a hosted zone is public."""
+        return not zone.get('Config', {}).get('PrivateZone')
+
+    def list_zones(self):
+        """List all public hosted zones."""
         paginator = self.client.get_paginator('list_hosted_zones')
         for page in paginator.paginate():
             for zone in page['HostedZones']:
-                if domain_name.endswith(zone['Name'][:-1]):
-                    return zone
-        return None
+                if self.is_public(zone):
+                    yield zone
+
+    def load_zones(self, refresh=False):
+        """Get the ZoneTrie of all public zones, loading it once.
+
+        The cached zones are used unless refresh is given.
+        """
+        if self.zones is None or refresh:
+            zones = None
+            if self.cache is not None and not refresh:
+                zones = self.cache.get(self.cache_key)
+            if zones is None:
+                zones = list(self.list_zones())
+                self.zones_listed = True
+            self.zones = ZoneTrie(zones)
+            self.save_zones()
+        return self.zones
+
+    def save_zones(self):
+        """Write the loaded zones to the local cache.
+
+        Zones listed in one request are never cached, checking a cached
+        match costs as much as listing them again.
+        """
+        if self.cache is not None and \
+                len(self.zones.zones) > self.LIST_PAGE_SIZE:
+            self.cache.put(self.cache_key, self.zones.zones)
+            self.cache.flush()
+
+    def cached_zone_valid(self, zone, domain_names):
+        """Check a cached zone matched by domain_names in one request.
+
+        Route53 lists zones by name with the labels reversed, starting
+        at the given name, so the zone comes first and any zone nested
+        in it follows before the names of domain_names.  The zone must
+        be unchanged and no nested zone may contain one of the names.
+        """
+        response = self.client.list_hosted_zones_by_name(
+            DNSName=zone['Name'], MaxItems=str(self.LIST_PAGE_SIZE))
+        found = response['HostedZones']
+        if not found or found[0]['Id'] != zone['Id']:
+            return False
+
+        last = max(labels(name) for name in domain_names)
+        if response.get('IsTruncated') and labels(found[-1]['Name']) <= last:
+            return False
+        for other in found[1:]:
+            if not self.is_public(other) or other['Id'] == zone['Id']:
+                continue
+            nested = labels(other['Name'])
+            if any(labels(name)[:len(nested)] == nested
+                   for name in domain_names):
+                return False
+        return True
+
+    def cached_matches_valid(self, matches):
+        """Check matches made with the cached zones.
+
+        Each matched zone is checked with one request.  A domain without
+        a cached zone, or more zones than listing all of them takes
+        requests, makes the matches stale.
+        """
+        zones = {}
+        for domain_name, zone in matches.items():
+            if zone is None:
+                return False
+            zones.setdefault(zone['Id'], (zone, []))[1].append(domain_name)
+
+        pages = -(-len(self.zones.zones) // self.LIST_PAGE_SIZE)
+        if len(zones) >= pages:
+            return False
+        return all(self.cached_zone_valid(zone, domain_names)
+                   for zone, domain_names in zones.values())
+
+    def find_hostedzones(self, domain_names):
+        """Get a dict of every domain name to its hosted zone or None.
+
+        Matches from the cached zones are checked once per domain name.
+        """
+        zones = self.load_zones()
+        matches = {name: zones.longest_match(name) for name in domain_names}
+        unchecked = {name: zone for name, zone in matches.items()
+                     if name not in self.checked}
+        if not self.zones_listed and unchecked and \
+                not self.cached_matches_valid(unchecked):
+            zones = self.load_zones(refresh=True)
+            matches = {name: zones.longest_match(name)
+                       for name in domain_names}
+        self.checked.update(domain_names)
+        return matches
+
+    def find_hostedzone(self, domain_name):
+        """Find the most specific hosted zone for the given domain name."""
+        return self.find_hostedzones([domain_name])[domain_name]
+
+    def ensure_hostedzone(self, domain_name):
+        """Find the hosted zone of domain_name, creating it if missing.
+
+        Lookups and creations are serialised, so concurrent callers for
+        domains of one new zone create it only once.
+        """
+        with self.lock:
+            return self.find_hostedzone(domain_name) or \
+                self.create_hostedzone(domain_name)
 
     def create_hostedzone(self, domain_name):
         """Create a hosted zone for an given domain name."""
         zone_name = '.'.join(domain_name.split('.')[-2:])
-        return self.client.create_hosted_zone(
+        zone = self.client.create_hosted_zone(
             Name=zone_name,
             CallerReference=str(uuid.uuid4())
-        )
+        )['HostedZone']
+        self.load_zones().add(zone)
+        self.save_zones()
+        return zone
 
-    def create_s3_domain_record(self, zone, domain_name, endpoint):
-        """Create A Record for the s3 domain."""
+    @staticmethod
+    def alias_record(domain_name, hosted_zone_id, dns_name):
+        """Get an A record set aliasing domain_name to dns_name."""
+        return {
+            'Name': domain_name,
+            'Type': 'A',
+            'AliasTarget': {
+                'HostedZoneId': hosted_zone_id,
+                'DNSName': dns_name,
+                'EvaluateTargetHealth': False
+                }
+        }
+
+    def change_records(self, zone, record_sets):
+        """UPSERT record sets in the zone in one change batch."""
         return self.client.change_resource_record_sets(
             HostedZoneId=zone['Id'],
             ChangeBatch={
@@ -38,39 +194,100 @@ class DomainManager:
                 'Changes': [
                     {
                         'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': endpoint.zone,
-                                'DNSName': endpoint.host,
-                                'EvaluateTargetHealth': False
-                                }
-                        }
+                        'ResourceRecordSet': record_set
                     }
+                    for record_set in record_sets
                 ]
             }
         )
 
+    def create_s3_domain_record(self, zone, domain_name, endpoint):
+        """Create A Record for the s3 domain."""
+        return self.change_records(zone, [self.alias_record(
+            domain_name, endpoint.zone, endpoint.host)])
+
     def create_cf_domain_record(self, zone, domain_name, cf_domain):
         """Create A Record for the s3 domain."""
-        return self.client.change_resource_record_sets(
-            HostedZoneId=zone['Id'],
-            ChangeBatch={
-                'Comment': 'Created by py script webauto',
-                'Changes': [
-                    {
-                        'Action': 'UPSERT',
-                        'ResourceRecordSet': {
-                            'Name': domain_name,
-                            'Type': 'A',
-                            'AliasTarget': {
-                                'HostedZoneId': 'Z2FDTNDATAQYW2',
-                                'DNSName': cf_domain,
-                                'EvaluateTargetHealth': False
-                                }
-                        }
-                    }
-                ]
-            }
-        )
+        return self.change_records(zone, [self.alias_record(
+            domain_name, self.CLOUDFRONT_ZONE, cf_domain)])
+
+    def record_matches(self, zone, record_set):
+        """Check if the zone already has the alias record set."""
+        name = record_set['Name'].rstrip('.').lower()
+        response = self.client.list_resource_record_sets(
+            HostedZoneId=zone['Id'], StartRecordName=name,
+            StartRecordType=record_set['Type'], MaxItems='1')
+        for existing in response['ResourceRecordSets']:
+            if existing['Name'].rstrip('.').lower() != name or \
+                    existing['Type'] != record_set['Type']:
+                return False
+            alias = existing.get('AliasTarget', {})
+            target = record_set['AliasTarget']
+            return alias.get('HostedZoneId') == target['HostedZoneId'] and \
+                alias.get('DNSName', '').rstrip('.').lower() == \
+                target['DNSName'].rstrip('.').lower()
+        return False
+
+    @classmethod
+    def batches(cls, record_sets):
+        """Split record sets into change batches Route53 accepts.
+
+        A batch holds at most 1000 records, every record of an UPSERT
+        counting twice, and at most 32000 characters of record values.
+        """
+        batch, count, size = [], 0, 0
+        for record_set in record_sets:
+            values = [record['Value']
+                      for record in record_set.get('ResourceRecords', [])]
+            record_count = 2 * max(len(values), 1)
+            record_size = sum(len(value) for value in values)
+            if batch and (count + record_count > cls.MAX_BATCH_RECORDS or
+                          size + record_size > cls.MAX_BATCH_SIZE):
+                yield batch
+                batch, count, size = [], 0, 0
+            batch.append(record_set)
+            count += record_count
+            size += record_size
+        if batch:
+            yield batch
+
+    def upsert_records(self, record_sets, wait=True):
+        """UPSERT many record sets, batched per hosted zone.
+
+        Record sets are grouped by the zone of their name, creating the
+        zones that are missing, and the zones are submitted concurrently.
+        With wait, returns once all changes are in sync.  Returns the
+        change IDs.
+        """
+        self.find_hostedzones([record_set['Name']
+                               for record_set in record_sets])
+        zones = {}
+        for record_set in record_sets:
+            name = record_set['Name']
+            zone = self.ensure_hostedzone(name)
+            zones.setdefault(zone['Id'], (zone, []))[1].append(record_set)
+
+        def submit(zone, zone_record_sets):
+            # Batches of a zone go one at a time, Route53 rejects a change
+            # to a zone while a previous one is still being applied.
+            return [self.change_records(zone, batch)['ChangeInfo']['Id']
+                    for batch in self.batches(zone_record_sets)]
+
+        with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+            change_ids = [change_id for zone_change_ids in executor.map(
+                lambda item: submit(*item), zones.values())
+                for change_id in zone_change_ids]
+
+        if wait:
+            self.wait_for_changes(change_ids)
+        return change_ids
+
+    def wait_for_changes(self, change_ids):
+        """Wait until every change is in sync.
+
+        The changes propagate concurrently, so waiting on them in turn
+        takes about as long as the slowest one.
+        """
+        waiter = self.client.get_waiter('resource_record_sets_changed')
+        for change_id in change_ids:
+            waiter.wait(Id=change_id)
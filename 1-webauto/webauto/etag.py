@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Compute S3 style ETags for local files.
+
+    - Single part files get the plain md5 of their content
+    - Multipart files get the md5 of the part digests suffixed with -N
+
+Files are streamed through a reused buffer so memory stays constant
+whatever the file size, and the parts of large files can be hashed
+concurrently.
+"""
+
+import os
+from hashlib import md5
+
+MIB = 1048576
+BUFFER_SIZE = MIB
+TASK_SIZE = 64 * MIB
+MAX_CANDIDATES = 4
+
+# Part sizes used by the console, the AWS CLI and common SDK defaults.
+COMMON_PART_SIZES = [8 * MIB, 5 * MIB, 16 * MIB, 15 * MIB, 10 * MIB,
+                     64 * MIB, 100 * MIB, 128 * MIB, 256 * MIB, 512 * MIB]
+
+
+def part_count(size, part_size):
+    """Get the number of parts S3 uses for size bytes in part_size parts."""
+    return max(1, -(-size // part_size))
+
+
+def etag_parts(etag):
+    """Get the number of parts from the -N suffix of an ETag."""
+    _, _, parts = etag.strip('"').partition('-')
+    return int(parts) if parts.isdigit() else 1
+
+
+def as_multipart(etag):
+    """Convert a single part ETag to the ETag of a one part upload."""
+    digest = bytes.fromhex(etag.strip('"'))
+    return '"{}-1"'.format(md5(digest).hexdigest())
+
+
+def candidate_part_sizes(etag, size, preferred):
+    """Get the part sizes that could have produced etag for size bytes.
+
+    The preferred size and the common tool defaults are tried first,
+    then the smallest MiB aligned size giving the same number of parts.
+    """
+    parts = etag_parts(etag)
+    if parts == 1:
+        return [max(preferred, size, 1)]
+
+    lowest = -(-size // parts)
+    aligned = -(-lowest // MIB) * MIB
+    candidates = []
+    for part_size in [preferred] + COMMON_PART_SIZES + [aligned, lowest]:
+        if part_size not in candidates and \
+                part_count(size, part_size) == parts:
+            candidates.append(part_size)
+
+    return candidates[:MAX_CANDIDATES]
+
+
+def part_digests(path, part_size, first=0, count=None):
+    """Get md5 digests of count parts of path, starting at part first."""
+    digests = []
+    view = memoryview(bytearray(min(part_size, BUFFER_SIZE)))
+
+    with open(path, 'rb', buffering=0) as f:
+        f.seek(first * part_size)
+        while count is None or len(digests) < count:
+            part = md5()
+            remaining = part_size
+            while remaining:
+                read = f.readinto(view[:min(remaining, len(view))])
+                if not read:
+                    break
+                part.update(view[:read])
+                remaining -= read
+
+            if remaining == part_size:
+                break
+            digests.append(part.digest())
+
+    return digests
+
+
+def combine_digests(digests):
+    """Build the quoted ETag from the part digests of a file."""
+    if len(digests) <= 1:
+        return '"{}"'.format((digests[0] if digests else md5().digest()).hex())
+
+    combined = md5()
+    for digest in digests:
+        combined.update(digest)
+    return '"{}-{}"'.format(combined.hexdigest(), len(digests))
+
+
+def compute_etag(path, part_size, executor=None):
+    """Compute the ETag S3 gives path when uploaded in part_size parts.
+
+    With an executor, files larger than TASK_SIZE are split into ranges
+    of parts that are hashed concurrently.  hashlib releases the GIL
+    while hashing, so a thread pool is enough to use several cores.
+    """
+    size = os.path.getsize(path)
+    if executor is None or size <= TASK_SIZE:
+        return combine_digests(part_digests(path, part_size))
+
+    parts = part_count(size, part_size)
+    step = max(1, TASK_SIZE // part_size)
+    futures = [executor.submit(part_digests, path, part_size, first, step)
+               for first in range(0, parts, step)]
+
+    digests = []
+    for future in futures:
+        digests.extend(future.result())
+    return combine_digests(digests)
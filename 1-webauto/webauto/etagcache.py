@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Class ETagCache to remember local file ETags between syncs."""
+
+import os
+import sqlite3
+import threading
+
+from webauto import util
+
+
+class ETagCache:
+    """Persist ETags of local files keyed by path, size, mtime and chunk size.
+
+    An entry is only returned while the file's size and mtime are the
+    same as when it was hashed, so a cache hit costs a single stat.
+    """
+
+    FILENAME = 'etags.sqlite'
+
+    def __init__(self, path=None):
+        """Open (or create) the cache database."""
+        self.path = str(path or util.cache_dir() / self.FILENAME)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS etags ('
+            ' path TEXT NOT NULL,'
+            ' chunk_size INTEGER NOT NULL,'
+            ' size INTEGER NOT NULL,'
+            ' mtime INTEGER NOT NULL,'
+            ' etag TEXT NOT NULL,'
+            ' PRIMARY KEY (path, chunk_size))')
+        self.db.commit()
+
+    @staticmethod
+    def file_key(path, stat=None):
+        """Get the (path, size, mtime) identity of a local file."""
+        stat = stat or os.stat(path)
+        return os.path.abspath(path), stat.st_size, stat.st_mtime_ns
+
+    def get(self, path, chunk_size, stat=None):
+        """Get the cached ETag for path or None if it is stale or missing."""
+        path, size, mtime = self.file_key(path, stat)
+        with self.lock:
+            row = self.db.execute(
+                'SELECT etag FROM etags WHERE path = ? AND chunk_size = ?'
+                ' AND size = ? AND mtime = ?',
+                (path, chunk_size, size, mtime)).fetchone()
+        return row[0] if row else None
+
+    def put(self, path, chunk_size, etag, stat=None):
+        """Store the ETag computed for path."""
+        path, size, mtime = self.file_key(path, stat)
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO etags VALUES (?, ?, ?, ?, ?)',
+                (path, chunk_size, size, mtime, etag))
+
+    def flush(self):
+        """Write pending entries to disk."""
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.db.close()
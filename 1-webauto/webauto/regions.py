@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""Class RegionResolver to find the home region of S3 buckets."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from webauto.ttlcache import TTLCache
+
+# Legacy location constraints returned by get_bucket_location.
+LEGACY_LOCATIONS = {None: 'us-east-1', '': 'us-east-1', 'EU': 'eu-west-1'}
+
+
+class RegionResolver:
+    """Look up bucket regions once and remember them between runs.
+
+    A bucket keeps its region for as long as it exists, so the TTL only
+    bounds how long a deleted and recreated bucket is looked for in its
+    old region.
+    """
+
+    TTL = 7 * 24 * 3600
+    WORKERS = 8
+
+    def __init__(self, client, cache=None):
+        """Create RegionResolver using an S3 client of any region."""
+        self.client = client
+        self.cache = cache if cache is not None \
+            else TTLCache('regions', self.TTL)
+
+    def fetch(self, bucket_name):
+        """Ask S3 for the region of bucket_name."""
+        location = self.client.get_bucket_location(Bucket=bucket_name)
+        constraint = location['LocationConstraint']
+        return LEGACY_LOCATIONS.get(constraint, constraint)
+
+    def lookup(self, bucket_name):
+        """Get the region of bucket_name."""
+        region = self.cache.get(bucket_name)
+        if region is None:
+            region = self.remember(bucket_name, self.fetch(bucket_name))
+        return region
+
+    def lookup_all(self, bucket_names):
+        """Get a dict of bucket name to region, fetching misses in parallel.
+
+        Buckets whose region cannot be read are left out.
+        """
+        regions = {}
+        missing = []
+        for name in bucket_names:
+            region = self.cache.get(name)
+            if region is None:
+                missing.append(name)
+            else:
+                regions[name] = region
+
+        def fetch(name):
+            try:
+                return name, self.fetch(name)
+            except ClientError as error:
+                print("Cannot get region of {}: {}".format(name, error))
+                return name, None
+
+        if missing:
+            with ThreadPoolExecutor(max_workers=self.WORKERS) as executor:
+                for name, region in executor.map(fetch, missing):
+                    if region:
+                        regions[name] = region
+                        self.cache.put(name, region)
+            self.cache.flush()
+        return regions
+
+    def remember(self, bucket_name, region):
+        """Cache the region of bucket_name and return it."""
+        self.cache.put(bucket_name, region)
+        self.cache.flush()
+        return region
+
+    def forget(self, bucket_name):
+        """Drop the cached region of bucket_name."""
+        self.cache.discard(bucket_name)
+        self.cache.flush()
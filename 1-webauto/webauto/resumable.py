@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable multipart uploads for large files.
+
+    - The upload ID and the ETag of every finished part are checkpointed
+      to a local file, so an interrupted upload resumes where it stopped
+    - On resume the checkpoint is reconciled with list_parts and only
+      the missing parts are uploaded, in parallel
+    - Multipart uploads abandoned for longer than a threshold can be
+      aborted so their parts stop costing storage
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from webauto import util
+
+MAX_PARTS = 10000
+
+
+def part_size_for(size, part_size):
+    """Double part_size until size fits in MAX_PARTS parts.
+
+    This is the same adjustment boto3's managed transfers make, so both
+    upload paths produce the same ETag.
+    """
+    while -(-size // part_size) > MAX_PARTS:
+        part_size *= 2
+    return part_size
+
+
+def abort_stale_uploads(client, bucket_name, older_than):
+    """Abort multipart uploads started more than older_than ago.
+
+    older_than is a datetime.timedelta.  Returns the aborted keys.
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - older_than
+    aborted = []
+    paginator = client.get_paginator('list_multipart_uploads')
+    for page in paginator.paginate(Bucket=bucket_name):
+        for upload in page.get('Uploads', []):
+            if upload['Initiated'] < cutoff:
+                client.abort_multipart_upload(
+                    Bucket=bucket_name, Key=upload['Key'],
+                    UploadId=upload['UploadId'])
+                aborted.append(upload['Key'])
+    return aborted
+
+
+class ResumableUpload:
+    """Upload a file in parts, checkpointing progress to resume later."""
+
+    def __init__(self, client, bucket_name, key, path, part_size,
+                 extra_args=None, workers=8, checkpoint_dir=None):
+        """Create ResumableUpload of path to key in bucket_name."""
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.path = os.path.abspath(path)
+        self.stat = os.stat(self.path)
+        self.part_size = part_size_for(self.stat.st_size, part_size)
+        self.extra_args = extra_args or {}
+        self.workers = workers
+        self.lock = threading.Lock()
+
+        directory = checkpoint_dir or util.cache_dir() / 'uploads'
+        os.makedirs(str(directory), exist_ok=True)
+        name = hashlib.sha1('\0'.join(
+            [bucket_name, key, self.path]).encode('utf-8')).hexdigest()
+        self.checkpoint_path = os.path.join(str(directory), name + '.json')
+        self.checkpoint = None
+
+    @property
+    def part_count(self):
+        """Get the number of parts of the file."""
+        return max(1, -(-self.stat.st_size // self.part_size))
+
+    def load_checkpoint(self):
+        """Load the checkpoint if it is for the current file contents."""
+        try:
+            with open(self.checkpoint_path) as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if (checkpoint.get('size'), checkpoint.get('mtime'),
+                checkpoint.get('part_size')) != \
+                (self.stat.st_size, self.stat.st_mtime_ns, self.part_size):
+            self.abort(checkpoint.get('upload_id'))
+            return None
+        return checkpoint
+
+    def save_checkpoint(self):
+        """Atomically write the checkpoint."""
+        directory = os.path.dirname(self.checkpoint_path)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.checkpoint, f)
+        os.replace(temp, self.checkpoint_path)
+
+    def abort(self, upload_id):
+        """Abort a multipart upload, ignoring ones already gone."""
+        if not upload_id:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.key, UploadId=upload_id)
+        except ClientError as error:
+            if error.response['Error']['Code'] != 'NoSuchUpload':
+                raise error
+
+    def start(self):
+        """Start a new multipart upload and checkpoint it."""
+        response = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, **self.extra_args)
+        self.checkpoint = {
+            'bucket': self.bucket_name,
+            'key': self.key,
+            'path': self.path,
+            'size': self.stat.st_size,
+            'mtime': self.stat.st_mtime_ns,
+            'part_size': self.part_size,
+            'upload_id': response['UploadId'],
+            'parts': {}
+        }
+        self.save_checkpoint()
+
+    def read_part(self, number):
+        """Read part number (from 1) of the file."""
+        with open(self.path, 'rb') as f:
+            f.seek((number - 1) * self.part_size)
+            return f.read(self.part_size)
+
+    def reconcile(self):
+        """Match the checkpointed parts with those S3 has.
+
+        Returns False if the upload no longer exists.  Parts S3 has but
+        the checkpoint misses (the process died before saving) are kept
+        when their ETag matches the local data.
+        """
+        uploaded = {}
+        paginator = self.client.get_paginator('list_parts')
+        try:
+            for page in paginator.paginate(
+                    Bucket=self.bucket_name, Key=self.key,
+                    UploadId=self.checkpoint['upload_id']):
+                for part in page.get('Parts', []):
+                    uploaded[str(part['PartNumber'])] = part['ETag']
+        except ClientError as error:
+            if error.response['Error']['Code'] == 'NoSuchUpload':
+                return False
+            raise error
+
+        parts = {}
+        for number, etag in uploaded.items():
+            if self.checkpoint['parts'].get(number) == etag or \
+                    '"{}"'.format(hashlib.md5(self.read_part(
+                        int(number))).hexdigest()) == etag:
+                parts[number] = etag
+        self.checkpoint['parts'] = parts
+        self.save_checkpoint()
+        return True
+
+    def upload_part(self, number, callback=None):
+        """Upload part number and checkpoint its ETag."""
+        body = self.read_part(number)
+        response = self.client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, Body=body,
+            PartNumber=number, UploadId=self.checkpoint['upload_id'])
+        with self.lock:
+            self.checkpoint['parts'][str(number)] = response['ETag']
+            self.save_checkpoint()
+        if callback:
+            callback(len(body))
+
+    def upload(self, Callback=None):
+        """Upload the file, resuming a checkpointed upload if possible.
+
+        Callback is called with the bytes sent after each part, like the
+        callback of boto3's managed transfers.
+        """
+        self.checkpoint = self.load_checkpoint()
+        if self.checkpoint is None or not self.reconcile():
+            self.start()
+
+        missing = [number for number in range(1, self.part_count + 1)
+                   if str(number) not in self.checkpoint['parts']]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for future in [executor.submit(self.upload_part, n, Callback)
+                           for n in missing]:
+                future.result()
+
+        parts = [{'PartNumber': int(number), 'ETag': etag}
+                 for number, etag in self.checkpoint['parts'].items()]
+        result = self.client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key,
+            UploadId=self.checkpoint['upload_id'],
+            MultipartUpload={
+                'Parts': sorted(parts, key=lambda p: p['PartNumber'])})
+        os.remove(self.checkpoint_path)
+        return result
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Serialize bucket manifests to a compact snapshot object.
+
+A snapshot is a gzipped stream of JSON lines holding the key, ETag,
+size and metadata fingerprint of every object in the bucket in key
+order, so a sync can load the whole manifest with a single GET instead
+of listing the bucket.
+The first line identifies the bucket and the last line holds the
+object count, which lets a reader detect truncated snapshots.
+"""
+
+import gzip
+import json
+
+VERSION = 3
+# Versions read, those before 3 lack the metadata fingerprint
+READ_VERSIONS = (2, 3)
+
+
+class SnapshotWriter:
+    """Write manifest entries, in key order, to a snapshot file."""
+
+    def __init__(self, bucket_name, fileobj):
+        """Start a snapshot for bucket_name in fileobj."""
+        self.gzip = gzip.GzipFile(fileobj=fileobj, mode='wb', mtime=0)
+        self.count = 0
+        self.write_line({'version': VERSION, 'bucket': bucket_name})
+
+    def write_line(self, value):
+        """Write a JSON line to the snapshot."""
+        self.gzip.write(json.dumps(value, separators=(',', ':'))
+                        .encode('utf-8') + b'\n')
+
+    def add(self, key, etag, size, meta=None):
+        """Add an object to the snapshot."""
+        self.write_line([key, etag, size, meta])
+        self.count += 1
+
+    def close(self):
+        """Finish the snapshot, the underlying file is left open."""
+        self.write_line({'count': self.count})
+        self.gzip.close()
+
+
+def read_snapshot(bucket_name, fileobj):
+    """Yield (key, etag, size, meta) for every object in a snapshot file.
+
+    Raises ValueError when the snapshot is corrupt, truncated, out of
+    order, was written by another version or belongs to another bucket.
+    """
+    try:
+        lines = gzip.GzipFile(fileobj=fileobj, mode='rb')
+        header = json.loads(lines.readline().decode('utf-8') or 'null')
+        if not isinstance(header, dict) or \
+                header.get('version') not in READ_VERSIONS:
+            raise ValueError('Unsupported manifest snapshot version')
+        if header.get('bucket') != bucket_name:
+            raise ValueError('Manifest snapshot is for another bucket')
+
+        count = 0
+        last_key = None
+        for line in lines:
+            value = json.loads(line.decode('utf-8'))
+            if isinstance(value, dict):
+                if value.get('count') != count:
+                    raise ValueError('Manifest snapshot count mismatch')
+                return
+
+            key, etag, size, meta = (value + [None])[:4]
+            if last_key is not None and key <= last_key:
+                raise ValueError('Manifest snapshot is not in key order')
+            last_key = key
+            count += 1
+            yield key, etag, size, meta
+    except (OSError, EOFError, UnicodeDecodeError) as error:
+        raise ValueError('Unreadable manifest snapshot: {}'.format(error))
+
+    raise ValueError('Manifest snapshot is truncated')
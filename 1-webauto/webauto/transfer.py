@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Classes to pace transfers to AWS.
+
+    - TokenBucket limits a rate (bytes or requests per second)
+    - TransferController adapts the number of concurrent transfers,
+      backing off when S3 throttles and growing while throughput
+      improves, and retries throttled transfers with jittered backoff
+"""
+
+import random
+import re
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+THROTTLE_CODES = {
+    'SlowDown', 'Throttling', 'ThrottlingException', 'ThrottledException',
+    'RequestLimitExceeded', 'TooManyRequestsException',
+    'ServiceUnavailable', 'RequestThrottled', 'PriorRequestNotComplete',
+    '503'
+}
+
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    """Parse a rate like 500K or 10M (bytes per second) to an int."""
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*',
+                         value.upper())
+    if not match:
+        raise ValueError('Invalid rate {}'.format(value))
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def is_throttle(error):
+    """Check if error is AWS asking us to slow down."""
+    if isinstance(error, ClientError):
+        response = error.response
+        return response.get('Error', {}).get('Code') in THROTTLE_CODES or \
+            response.get('ResponseMetadata', {}).get('HTTPStatusCode') == 503
+
+    # Managed transfers wrap the ClientError in their own exception type,
+    # keeping only its message.
+    message = str(error)
+    return any('({})'.format(code) in message for code in THROTTLE_CODES)
+
+
+class TokenBucket:
+    """Limit a rate shared by many threads."""
+
+    def __init__(self, rate, capacity=None):
+        """Create TokenBucket allowing rate units per second."""
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=1):
+        """Take amount tokens, sleeping until the rate allows it.
+
+        Amounts larger than the capacity are allowed, the bucket then
+        goes into debt and later callers wait for it to refill.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+class TransferController:
+    """Run transfers with adaptive concurrency (AIMD) and retries.
+
+    The concurrency limit is halved when AWS throttles, at most once per
+    COOLDOWN seconds, and grows by one after each WINDOW seconds in
+    which throughput improved by at least GROWTH.
+    """
+
+    WINDOW = 2.0
+    COOLDOWN = 1.0
+    GROWTH = 1.05
+
+    def __init__(self, max_concurrency, initial=None, max_bandwidth=None,
+                 max_retries=8, base_delay=0.5, max_delay=30.0):
+        """Create TransferController.
+
+        max_bandwidth, in bytes per second, caps the combined rate of all
+        uploads reporting progress through upload_callback.
+        """
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = min(self.max_concurrency,
+                         initial or max(1, self.max_concurrency // 2))
+        self.bandwidth = TokenBucket(max_bandwidth) if max_bandwidth \
+            else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.condition = threading.Condition()
+        self.active = 0
+        self.completed = 0
+        self.retries = 0
+        self.throttles = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.window_start = self.started
+        self.window_bytes = 0
+        self.last_throughput = 0.0
+        self.last_throttle = 0.0
+
+    def acquire(self):
+        """Wait for a transfer slot."""
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        """Give back a transfer slot."""
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def callback(self, transferred):
+        """Record progress, for use as a boto3 transfer Callback."""
+        with self.condition:
+            self.bytes += transferred
+            self.window_bytes += transferred
+
+    def upload_callback(self, transferred):
+        """Record upload progress, holding it to max_bandwidth."""
+        self.callback(transferred)
+        if self.bandwidth:
+            self.bandwidth.consume(transferred)
+
+    def on_success(self):
+        """Grow the limit if the last window's throughput improved."""
+        with self.condition:
+            self.completed += 1
+            now = time.monotonic()
+            if now - self.window_start < self.WINDOW:
+                return
+
+            throughput = self.window_bytes / (now - self.window_start)
+            if throughput >= self.last_throughput * self.GROWTH and \
+                    self.limit < self.max_concurrency:
+                self.limit += 1
+                self.condition.notify_all()
+            self.last_throughput = throughput
+            self.window_start = now
+            self.window_bytes = 0
+
+    def on_throttle(self):
+        """Halve the limit after AWS throttled a transfer."""
+        with self.condition:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self.last_throttle >= self.COOLDOWN:
+                self.limit = max(1, self.limit // 2)
+                self.last_throttle = now
+
+    def run(self, func, *args, **kwargs):
+        """Call func in a transfer slot, retrying it when throttled."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as error:
+                if not is_throttle(error) or attempt == self.max_retries:
+                    raise
+                self.on_throttle()
+            else:
+                self.on_success()
+                return result
+            finally:
+                self.release()
+
+            with self.condition:
+                self.retries += 1
+            # Full jitter: sleep a random time up to the capped backoff.
+            time.sleep(random.uniform(0, min(
+                self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def stats(self):
+        """Get live statistics of the transfers."""
+        with self.condition:
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            return {
+                'limit': self.limit,
+                'active': self.active,
+                'completed': self.completed,
+                'retries': self.retries,
+                'throttles': self.throttles,
+                'bytes': self.bytes,
+                'throughput': self.bytes / elapsed
+            }
+
+    def __str__(self):
+        """Summarize the live statistics."""
+        stats = self.stats()
+        return ('{active}/{limit} transfers active, {completed} done, '
+                '{throttles} throttled, {retries} retried, '
+                '{mib:.1f} MiB at {rate:.1f} MiB/s').format(
+                    mib=stats['bytes'] / 1048576,
+                    rate=stats['throughput'] / 1048576, **stats)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""Class TTLCache to remember AWS lookups between runs."""
+
+import json
+import os
+import tempfile
+import threading
+import time
+
+from webauto import util
+
+
+class TTLCache:
+    """Persist JSON values in the cache directory for ttl seconds.
+
+    Entries are stored as [timestamp, value] in one small JSON file per
+    cache, so values must be JSON serializable.  A missing or corrupt
+    file is treated as an empty cache.
+    """
+
+    def __init__(self, name, ttl, directory=None):
+        """Load the cache called name, keeping entries for ttl seconds."""
+        self.path = os.path.join(str(directory or util.cache_dir()),
+                                 name + '.json')
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        if not isinstance(self.entries, dict):
+            self.entries = {}
+
+    def get(self, key, default=None):
+        """Get the value cached under key, or default if it expired."""
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry and time.time() - entry[0] < self.ttl:
+            return entry[1]
+        return default
+
+    def put(self, key, value):
+        """Cache value under key."""
+        with self.lock:
+            self.entries[key] = [time.time(), value]
+            self.dirty = True
+
+    def discard(self, key):
+        """Forget the value cached under key, if any."""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self.dirty = True
+
+    def flush(self):
+        """Atomically write the unexpired entries, if any changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            now = time.time()
+            entries = {key: entry for key, entry in self.entries.items()
+                       if now - entry[0] < self.ttl}
+            self.dirty = False
+
+        directory = os.path.dirname(self.path)
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temp, self.path)
@@ -2,7 +2,10 @@
 
 """Utilities for webauto."""
 
+import hashlib
+import os
 from collections import namedtuple
+from pathlib import Path
 
 Endpoint = namedtuple('Endpoint', ['name', 'host', 'zone'])
 
@@ -36,3 +39,26 @@ def known_region(region):
 def get_endpoint(region):
     """Get the endpoint url for given region."""
     return region_to_endpoint[region]
+
+
+def cache_dir():
+    """Get the local cache directory for webauto, creating it if needed."""
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join('~', '.cache')
+    path = Path(base).expanduser() / 'webauto'
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def account_key(session):
+    """Get the key of the session's profile and credentials in local caches.
+
+    A profile, or the unnamed default one, can point at another account
+    from one run to the next.  An access key belongs to one account, so
+    keying cached listings by a hash of it keeps accounts apart without
+    asking AWS who the caller is.
+    """
+    credentials = session.get_credentials()
+    access_key = credentials.access_key if credentials else ''
+    profile = getattr(session, 'profile_name', None) or 'default'
+    return '{}:{}'.format(
+        profile, hashlib.sha256(access_key.encode()).hexdigest()[:16])
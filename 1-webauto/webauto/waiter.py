@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Class DeployWaiter to wait for many CloudFront changes at once.
+
+    - Every tracked change is polled on its own schedule, quickly at
+      first and less often the longer it takes, with jitter so many
+      changes started together do not poll in lockstep
+    - Tracking returns a Future, so callers carry on with other work and
+      only block when they need the change to be done
+"""
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future
+
+from webauto.transfer import is_throttle
+
+
+class DeployWaiter:
+    """Poll many changes from one background thread until they are done."""
+
+    def __init__(self, initial_delay=5.0, max_delay=60.0, factor=1.5,
+                 timeout=3600.0, on_progress=None):
+        """Create DeployWaiter.
+
+        The delay between polls of a change starts at initial_delay and
+        grows by factor up to max_delay.  A change not done after timeout
+        seconds fails with TimeoutError.  on_progress is called with a
+        message whenever a change is polled.
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.timeout = timeout
+        self.on_progress = on_progress
+        self.condition = threading.Condition()
+        self.queue = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def track(self, name, check):
+        """Poll check() until it returns true and get a Future of the wait.
+
+        The Future's result is the number of seconds waited.
+        """
+        future = Future()
+        now = time.monotonic()
+        with self.condition:
+            self.schedule(now, name, check, future, 0.0, now)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+        return future
+
+    def schedule(self, due, name, check, future, delay, started):
+        """Queue the next poll of a change, the condition must be held."""
+        heapq.heappush(self.queue, (due, next(self.counter), name, check,
+                                    future, delay, started))
+
+    def next_delay(self, delay):
+        """Get the growing delay before the next poll and its jittered due."""
+        delay = min(max(delay * self.factor, self.initial_delay),
+                    self.max_delay)
+        return delay, random.uniform(delay / 2, delay)
+
+    def report(self, message):
+        """Send a progress message to on_progress, if given."""
+        if self.on_progress:
+            self.on_progress(message)
+
+    def run(self):
+        """Poll the queued changes until none is left."""
+        while True:
+            with self.condition:
+                if not self.queue:
+                    self.thread = None
+                    return
+                wait = self.queue[0][0] - time.monotonic()
+                if wait > 0:
+                    self.condition.wait(wait)
+                    continue
+                _, _, name, check, future, delay, started = \
+                    heapq.heappop(self.queue)
+
+            try:
+                done = check()
+            except Exception as error:
+                if not is_throttle(error):
+                    future.set_exception(error)
+                    continue
+                done = False
+
+            elapsed = time.monotonic() - started
+            if done:
+                self.report("{} done after {:.0f}s".format(name, elapsed))
+                future.set_result(elapsed)
+            elif elapsed > self.timeout:
+                future.set_exception(TimeoutError(
+                    "{} not done after {:.0f}s".format(name, elapsed)))
+            else:
+                delay, pause = self.next_delay(delay)
+                self.report("{} in progress ({:.0f}s)".format(name, elapsed))
+                with self.condition:
+                    self.schedule(time.monotonic() + pause, name, check,
+                                  future, delay, started)
+
+    def pending(self):
+        """Count the changes still being waited for."""
+        with self.condition:
+            return len(self.queue)
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Walk a local tree for syncing.
+
+    - Iterative os.scandir walk, reusing the DirEntry type and stat
+    - Files are produced in the key order S3 lists them in
+    - gitignore style exclude rules from .webautoignore
+    - Symlinked directories looping back into the walked path are skipped
+"""
+
+import os
+import re
+from collections import namedtuple
+
+IGNORE_FILE = '.webautoignore'
+
+DEFAULT_IGNORES = [
+    '.git/', '.hg/', '.svn/', 'node_modules/', '__pycache__/',
+    '.DS_Store', 'Thumbs.db', '*.swp', '*.swo', '*~', '.#*', '#*#',
+    '.webauto-*.tmp', IGNORE_FILE
+]
+
+LocalFile = namedtuple('LocalFile', ['path', 'stat'])
+
+
+def translate(pattern):
+    """Translate a gitignore style pattern to a regular expression.
+
+    Returns the expression and whether the pattern only matches
+    directories.  Patterns without a slash match at any depth, others
+    are anchored at the root.
+    """
+    dir_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            parts.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            parts.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            if chars[0] == '!':
+                chars = '^' + chars[1:]
+            parts.append('[{}]'.format(chars))
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+
+    prefix = '' if anchored else '(?:.*/)?'
+    return prefix + ''.join(parts), dir_only
+
+
+class IgnoreRules:
+    """Match relative paths against a set of exclude patterns.
+
+    All patterns are compiled into one expression for files and one for
+    directories, so a path is checked with a single regex match.
+    Negated patterns (!pattern) are not supported and are skipped.
+    """
+
+    def __init__(self, patterns):
+        """Compile patterns into IgnoreRules."""
+        any_type = []
+        dirs = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            if pattern.startswith('!'):
+                print("Ignoring unsupported pattern {}".format(pattern))
+                continue
+
+            regex, dir_only = translate(pattern.lstrip('\\'))
+            dirs.append(regex)
+            if not dir_only:
+                any_type.append(regex)
+
+        self.files = self.compile(any_type)
+        self.dirs = self.compile(dirs)
+
+    @staticmethod
+    def compile(regexes):
+        """Combine regexes into one, or None if there are none."""
+        if not regexes:
+            return None
+        return re.compile('|'.join('(?:{})'.format(r) for r in regexes))
+
+    @classmethod
+    def from_root(cls, root, defaults=True):
+        """Load the default rules plus those in root/.webautoignore."""
+        patterns = list(DEFAULT_IGNORES) if defaults else []
+        try:
+            with open(os.path.join(str(root), IGNORE_FILE)) as f:
+                patterns.extend(f.read().splitlines())
+        except FileNotFoundError:
+            pass
+        return cls(patterns)
+
+    def ignored(self, key, is_dir=False):
+        """Check if the relative path key is excluded."""
+        regex = self.dirs if is_dir else self.files
+        return regex is not None and regex.fullmatch(key) is not None
+
+    def ignored_key(self, key):
+        """Check if a file key, or any directory above it, is excluded."""
+        parts = key.split('/')
+        for depth in range(1, len(parts)):
+            if self.ignored('/'.join(parts[:depth]), True):
+                return True
+        return self.ignored(key)
+
+
+def walk_files(root, rules=None, prefix=''):
+    """Yield (key, LocalFile) for every file under root in key order.
+
+    Keys are relative to root, after prefix, which lets a subdirectory
+    of a tree be walked with the tree's keys and rules.
+
+    Directories sort as their name plus '/', which makes a depth first
+    walk produce keys in the same order S3 lists them.  Symlinks are
+    followed, except to a directory already on the path being walked,
+    which is told by its device and inode.  Directories that cannot be
+    read are reported and skipped.
+    """
+    root = os.path.realpath(str(root))
+    root_stat = os.stat(root)
+    # Stack items are (key, path, ancestors) for directories, ancestors
+    # being the (st_dev, st_ino) of it and the directories above it, and
+    # (key, LocalFile) for files, pushed in reverse key order.
+    stack = [(prefix, root,
+              frozenset([(root_stat.st_dev, root_stat.st_ino)]))]
+
+    while stack:
+        item = stack.pop()
+        if len(item) == 2:
+            yield item
+            continue
+
+        prefix, path, ancestors = item
+        try:
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            continue
+        except OSError as error:
+            print("Skipping {}: {}".format(prefix or path, error))
+            continue
+
+        children = []
+        for entry in entries:
+            key = prefix + entry.name
+            try:
+                is_dir = entry.is_dir()
+                if rules and rules.ignored(key, is_dir):
+                    continue
+                if is_dir:
+                    stat = entry.stat()
+                    inode = (stat.st_dev, stat.st_ino)
+                    if inode in ancestors:
+                        print("Skipping symlink loop {}".format(key))
+                        continue
+                    children.append((key + '/', (key + '/', entry.path,
+                                                 ancestors | {inode})))
+                elif entry.is_file():
+                    children.append((key, (key, LocalFile(entry.path,
+                                                          entry.stat()))))
+            except FileNotFoundError:
+                continue
+            except OSError as error:
+                print("Skipping {}: {}".format(key, error))
+                continue
+
+        children.sort(key=lambda child: child[0], reverse=True)
+        stack.extend(child for _, child in children)
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Detect changes in a local tree for continuous syncing.
+
+    - TreeIndex keeps the size and mtime of every file and diffs a new
+      scandir walk, or a re-stat of some paths, against them
+    - With the optional watchdog package, file system events (inotify on
+      Linux) name the paths to re-stat; otherwise the whole tree is
+      polled every few seconds
+    - wait_for_changes debounces bursts of changes into one batch
+"""
+
+import os
+import threading
+import time
+
+from webauto.walk import LocalFile, walk_files
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+
+class TreeIndex:
+    """Index of the files under root, used to find what changed."""
+
+    def __init__(self, root, rules=None):
+        """Create TreeIndex with the current state of root."""
+        self.root = root
+        self.rules = rules
+        self.files = self.scan()
+
+    def scan(self):
+        """Walk root and get a dict of key to LocalFile."""
+        return dict(walk_files(self.root, self.rules))
+
+    @staticmethod
+    def same(old, new):
+        """Check if two LocalFile stats describe the same content."""
+        return (old.stat.st_size, old.stat.st_mtime_ns) == \
+            (new.stat.st_size, new.stat.st_mtime_ns)
+
+    def changes(self):
+        """Rescan root, returning changed files and removed keys.
+
+        Changed files are a dict of key to LocalFile.
+        """
+        files = self.scan()
+        changed = {key: local for key, local in files.items()
+                   if key not in self.files or
+                   not self.same(self.files[key], local)}
+        removed = set(self.files) - set(files)
+        self.files = files
+        return changed, removed
+
+    def key_of(self, path):
+        """Get the key of a path under root, or None if it is outside."""
+        key = os.path.relpath(path, str(self.root)).replace(os.sep, '/')
+        if key == '.' or key == '..' or key.startswith('../'):
+            return None
+        return key
+
+    def stat_path(self, path, key):
+        """Get a dict of key to LocalFile for the files at or under path."""
+        if self.rules and self.rules.ignored_key(key):
+            return {}
+        try:
+            if os.path.isdir(path):
+                if self.rules and self.rules.ignored(key, True):
+                    return {}
+                return dict(walk_files(path, self.rules, key + '/'))
+            if os.path.isfile(path):
+                return {key: LocalFile(path, os.stat(path))}
+        except FileNotFoundError:
+            pass
+        return {}
+
+    def refresh(self, paths):
+        """Re-stat only the given paths, returning what changed like changes.
+
+        A directory path is walked again, as files under it may have been
+        created, moved or removed with it.
+        """
+        changed, removed = {}, set()
+        for path in paths:
+            key = self.key_of(path)
+            if key is None:
+                continue
+            files = self.stat_path(path, key)
+            below = key + '/'
+            for old in [old for old in self.files
+                        if old == key or old.startswith(below)]:
+                if old not in files:
+                    del self.files[old]
+                    changed.pop(old, None)
+                    removed.add(old)
+            for new, local in files.items():
+                if new not in self.files or \
+                        not self.same(self.files[new], local):
+                    changed[new] = local
+                    removed.discard(new)
+                self.files[new] = local
+        return changed, removed
+
+
+class ChangeTrigger(FileSystemEventHandler):
+    """Collect the paths of the watched tree that changed."""
+
+    def __init__(self):
+        """Create ChangeTrigger."""
+        super().__init__()
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.paths = set()
+
+    def on_any_event(self, event):
+        """Handle a watchdog event."""
+        # A directory is reported modified whenever an entry in it
+        # changes, which its entries' own events already cover.
+        if event.is_directory and event.event_type == 'modified':
+            return
+        with self.lock:
+            self.paths.add(event.src_path)
+            dest_path = getattr(event, 'dest_path', None)
+            if dest_path:
+                self.paths.add(dest_path)
+        self.event.set()
+
+    def wait(self, timeout):
+        """Wait for changes, returning their paths or None if none came."""
+        if not self.event.wait(timeout):
+            return None
+        with self.lock:
+            self.event.clear()
+            paths, self.paths = self.paths, set()
+        return paths
+
+
+def start_trigger(root):
+    """Start watching root for events, or get None without watchdog."""
+    if Observer is None:
+        return None, None
+
+    trigger = ChangeTrigger()
+    observer = Observer()
+    observer.schedule(trigger, str(root), recursive=True)
+    observer.daemon = True
+    observer.start()
+    return trigger, observer
+
+
+def wait_for_changes(index, debounce=1.0, interval=1.0, max_delay=10.0,
+                     trigger=None, poll_interval=5.0):
+    """Wait for a batch of changes to the indexed tree.
+
+    Returns (changed, removed) once files changed and then stayed quiet
+    for debounce seconds, or max_delay seconds after the first change
+    if they keep changing.  With a trigger only the paths it reported
+    are re-stated, checking for events every interval; without one the
+    whole tree is rescanned every poll_interval.
+    """
+    changed, removed = {}, set()
+    first = last = None
+    interval = min(interval, debounce)
+
+    while True:
+        if trigger is None:
+            time.sleep(poll_interval)
+            new_changed, new_removed = index.changes()
+        else:
+            paths = trigger.wait(interval)
+            new_changed, new_removed = index.refresh(paths) if paths \
+                else ({}, set())
+
+        now = time.monotonic()
+        if new_changed or new_removed:
+            for key in new_removed:
+                changed.pop(key, None)
+            removed.difference_update(new_changed)
+            removed.update(new_removed)
+            changed.update(new_changed)
+            first = first or now
+            last = now
+            continue
+
+        if (changed or removed) and \
+                (now - last >= debounce or now - first >= max_delay):
+            return changed, removed
@@ -12,62 +12,56 @@ Webauto automates the process of deploying static web sites to aws.
 - Configure Cloudfront CDN and SSL with aws.
 """
 
-import boto3
-import click
-# from botocore.exceptions import ClientError
-
-
-from webauto.bucket import BucketManager
-from webauto.domain import DomainManager
-from webauto.certificate import CertificateManager
-from webauto.cdn import DistributionManager
+import datetime
+import threading
 
+import click
 
 from webauto import util
+from webauto.context import AWSContext
 
-# s3 = session.resource('s3')
-
-session = None
-bucket_manager = None
-domain_manager = None
-cert_manager = None
-dist_manager = None
+# Modules importing boto3 are imported inside the commands using them, so
+# every command only pays for what it needs at startup.
 
 
 @click.group()
 @click.option('--profile', default=None, help="Use an given AWS Profile")
-def cli(profile):
+@click.pass_context
+def cli(ctx, profile):
     """Webauto deploys blogs to aws."""
-    global session, bucket_manager, domain_manager, cert_manager, dist_manager
-    session_cfg = {}
-    if profile:
-        session_cfg['profile_name'] = profile
-    session = boto3.Session(**session_cfg)
-    bucket_manager = BucketManager(session)
-    domain_manager = DomainManager(session)
-    cert_manager = CertificateManager(session)
-    dist_manager = DistributionManager(session)
+    ctx.obj = AWSContext(profile)
+
+
+def report_progress(controller, interval, stopped):
+    """Print the controller's stats every interval until stopped."""
+    while not stopped.wait(interval):
+        print(controller)
 
 
 @cli.command('list_buckets')
-def list_buckets():
-    """List all s3 buckets in aws."""
-    for bucket in bucket_manager.all_buckets():
-        print(bucket)
+@click.pass_obj
+def list_buckets(aws):
+    """List all s3 buckets in aws with their regions."""
+    regions = aws.bucket_manager.bucket_regions()
+    for name in sorted(regions):
+        print("{}\t{}".format(name, regions[name]))
 
 
 @cli.command('list_bucket_objects')
 @click.argument('bucket')
-def list_bucket_objects(bucket):
+@click.pass_obj
+def list_bucket_objects(aws, bucket):
     """List all objects inside an S3 bucket."""
-    for obj in bucket_manager.all_objects(bucket):
+    for obj in aws.bucket_manager.all_objects(bucket):
         print(obj)
 
 
 @cli.command('configure_bucket')
 @click.argument('bucket')
-def configure_bucket(bucket):
+@click.pass_obj
+def configure_bucket(aws, bucket):
     """Create and Configure S3 bucket for website."""
+    bucket_manager = aws.bucket_manager
     s3_bucket = bucket_manager.init_bucket(bucket)
     bucket_manager.setpolicy(s3_bucket)
     bucket_manager.configurewebsite(s3_bucket)
@@ -76,37 +70,268 @@ def configure_bucket(bucket):
 @cli.command('sync_folder')
 @click.argument('pathname', type=click.Path(exists=True))
 @click.argument('bucket')
-def sync_folder(pathname, bucket):
-    """Sync contents from pathname or folder to S3 Bucket."""
-    bucket_manager.sync(pathname, bucket)
-    print(bucket_manager.get_bucket_url(bucket_manager.s3.Bucket(bucket)))
+@click.option('--workers', default=10, show_default=True,
+              help="Number of files hashed and uploaded concurrently")
+@click.option('--no-cache', is_flag=True,
+              help="Rehash every file instead of using the local ETag cache")
+@click.option('--full-scan', is_flag=True,
+              help="List the whole bucket instead of loading its snapshot, "
+                   "which is trusted for a day; use after objects were "
+                   "changed or deleted without webauto")
+@click.option('--delete', is_flag=True,
+              help="Delete objects that no longer exist in pathname")
+@click.option('--dry-run', is_flag=True,
+              help="Print the planned uploads and deletes only")
+@click.option('--invalidate', is_flag=True,
+              help="Invalidate changed files in the bucket's CloudFront CDN")
+@click.option('--assets-config', type=click.Path(exists=True),
+              help="JSON file with compression and Cache-Control rules")
+@click.option('--dedup', is_flag=True,
+              help="Copy content already in the bucket instead of uploading")
+@click.option('--max-bandwidth', default=None,
+              help="Cap upload bandwidth, e.g. 500K or 10M bytes per second")
+@click.option('--stats', is_flag=True,
+              help="Print transfer statistics every few seconds")
+@click.option('--resumable', is_flag=True,
+              help="Checkpoint large uploads so a rerun resumes them")
+@click.option('--watch', is_flag=True,
+              help="Keep running and sync files as they change")
+@click.option('--debounce', default=1.0, show_default=True,
+              help="Seconds without changes before a watch batch is synced")
+@click.pass_obj
+def sync_folder(aws, pathname, bucket, workers, no_cache, full_scan, delete,
+                dry_run, invalidate, assets_config, dedup, max_bandwidth,
+                stats, resumable, watch, debounce):
+    """Sync contents from pathname or folder to S3 Bucket.
+
+    At most WORKERS transfers run at once; fewer while S3 throttles.
+    """
+    from webauto.etagcache import ETagCache
+    from webauto.assets import AssetPolicy, Compressor
+    from webauto.transfer import TransferController, parse_rate
+
+    bucket_manager = aws.bucket_manager
+    if not no_cache:
+        bucket_manager.etag_cache = ETagCache()
+    if assets_config:
+        bucket_manager.asset_policy = AssetPolicy.from_file(assets_config)
+        bucket_manager.compressor = Compressor()
+    try:
+        bandwidth = parse_rate(max_bandwidth) if max_bandwidth else None
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--max-bandwidth')
+    controller = TransferController(workers, max_bandwidth=bandwidth)
+    bucket_manager.controller = controller
+    bucket_manager.resumable = resumable
+
+    stopped = threading.Event()
+    if stats:
+        threading.Thread(target=report_progress,
+                         args=(controller, 5, stopped), daemon=True).start()
+    try:
+        result = bucket_manager.sync(pathname, bucket, workers=workers,
+                                     full_scan=full_scan, delete=delete,
+                                     dry_run=dry_run, dedup=dedup,
+                                     keep_manifest=watch)
+    finally:
+        stopped.set()
+
+    if stats:
+        print(controller)
+    if dry_run:
+        for key in result.uploaded:
+            print("upload: {}".format(key))
+        for key in result.copied:
+            print("copy: {}".format(key))
+        for key in result.deleted:
+            print("delete: {}".format(key))
+        print(result)
+        return
+
+    print(result)
+    dist = None
+    if invalidate:
+        dist = aws.dist_manager.find_matching_dist(bucket)
+        if not dist:
+            print("No distribution found for {}".format(bucket))
+    invalidate_changes(aws, dist, result)
+
+    print(bucket_manager.get_bucket_url(bucket_manager.get_bucket(bucket)))
+
+    if watch:
+        print("Watching {} for changes, press Ctrl-C to stop".format(
+            pathname))
+
+        def on_batch(batch):
+            print(batch)
+            invalidate_changes(aws, dist, batch)
+
+        try:
+            bucket_manager.watch(pathname, bucket, workers=workers,
+                                 delete=delete, debounce=debounce,
+                                 on_batch=on_batch)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+
+
+def invalidate_changes(aws, dist, result):
+    """Invalidate the keys a sync changed, if there is a distribution."""
+    if dist and result.changed:
+        invalidation = aws.dist_manager.invalidate(dist, result.changed)
+        print("Invalidation {} created".format(invalidation['Id']))
+
+
+@cli.command('pull_folder')
+@click.argument('bucket')
+@click.argument('pathname', type=click.Path(file_okay=False))
+@click.option('--workers', default=10, show_default=True,
+              help="Number of objects downloaded concurrently")
+@click.option('--full-scan', is_flag=True,
+              help="List the whole bucket instead of loading its snapshot, "
+                   "which is trusted for a day; use after objects were "
+                   "changed or deleted without webauto")
+@click.option('--dry-run', is_flag=True,
+              help="Print the planned downloads only")
+@click.option('--assets-config', type=click.Path(exists=True),
+              help="JSON file with the compression rules the folder was "
+                   "synced with, to recognise unchanged compressed files")
+@click.pass_obj
+def pull_folder(aws, bucket, pathname, workers, full_scan, dry_run,
+                assets_config):
+    """Download changed objects from S3 Bucket to pathname."""
+    from webauto.assets import AssetPolicy, Compressor
+    from webauto.etagcache import ETagCache
+    from webauto.transfer import TransferController
+
+    bucket_manager = aws.bucket_manager
+    bucket_manager.etag_cache = ETagCache()
+    if assets_config:
+        bucket_manager.asset_policy = AssetPolicy.from_file(assets_config)
+        bucket_manager.compressor = Compressor()
+    bucket_manager.controller = TransferController(workers)
+    result = bucket_manager.pull(bucket, pathname, workers=workers,
+                                 full_scan=full_scan, dry_run=dry_run)
+    if dry_run:
+        for key in result.downloaded:
+            print("download: {}".format(key))
+    print(result)
+
+
+@cli.command('abort_uploads')
+@click.argument('bucket')
+@click.option('--older-than', default=24, show_default=True,
+              help="Abort multipart uploads started this many hours ago")
+@click.pass_obj
+def abort_uploads(aws, bucket, older_than):
+    """Abort abandoned multipart uploads in an S3 bucket."""
+    from webauto.resumable import abort_stale_uploads
+
+    s3_bucket = aws.bucket_manager.get_bucket(bucket)
+    aborted = abort_stale_uploads(s3_bucket.meta.client, bucket,
+                                  datetime.timedelta(hours=older_than))
+    for key in aborted:
+        print("Aborted upload of {}".format(key))
 
 
 @cli.command('setup_domain')
 @click.argument('domain')
-def setup_domain(domain):
+@click.pass_obj
+def setup_domain(aws, domain):
     """Configure domain to point to S3 bucket."""
+    bucket_manager = aws.bucket_manager
+    domain_manager = aws.domain_manager
     bucket = bucket_manager.get_bucket(domain)
-    zone = domain_manager.find_hostedzone(domain) \
-        or domain_manager.create_hostedzone(domain)
+    zone = domain_manager.ensure_hostedzone(domain)
     endpoint = util.get_endpoint(bucket_manager.get_region_name(bucket))
     a_record = domain_manager.create_s3_domain_record(zone, domain, endpoint)
     print("Domain configured: http://{}".format(domain))
     print(a_record)
 
 
+@cli.command('setup_domains')
+@click.argument('domains_file', type=click.File())
+@click.option('--no-wait', is_flag=True,
+              help="Do not wait for the DNS changes to propagate")
+@click.pass_obj
+def setup_domains(aws, domains_file, no_wait):
+    """Configure every domain in a file to point to its S3 bucket.
+
+    DOMAINS_FILE lists one domain per line, blank lines and lines
+    starting with # are ignored.  Like setup_domain, every domain points
+    to the bucket of the same name.
+    """
+    domains = [line.strip() for line in domains_file
+               if line.strip() and not line.strip().startswith('#')]
+    domain_manager = aws.domain_manager
+    regions = aws.bucket_manager.regions.lookup_all(domains)
+
+    record_sets = []
+    for domain in domains:
+        if domain in regions:
+            endpoint = util.get_endpoint(regions[domain])
+            record_sets.append(domain_manager.alias_record(
+                domain, endpoint.zone, endpoint.host))
+
+    domain_manager.upsert_records(record_sets, wait=not no_wait)
+    for record_set in record_sets:
+        print("Domain configured: http://{}".format(record_set['Name']))
+
+
+@cli.command('deploy')
+@click.argument('sites_file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--workers', default=16, show_default=True,
+              help="Number of deploy steps run concurrently")
+@click.option('--transfers', default=10, show_default=True,
+              help="Number of file transfers run concurrently over all sites")
+@click.pass_obj
+def deploy(aws, sites_file, workers, transfers):
+    """Deploy every site listed in a JSON sites file.
+
+    Each site's bucket, files, distribution and DNS record are set up,
+    skipping what is already in place, with all sites deployed at once.
+    """
+    from webauto.deploy import Deployment, load_sites, FAILED
+    from webauto.etagcache import ETagCache
+    from webauto.transfer import TransferController
+
+    try:
+        sites = load_sites(sites_file)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='SITES_FILE')
+
+    bucket_manager = aws.bucket_manager
+    bucket_manager.etag_cache = ETagCache()
+    bucket_manager.controller = TransferController(transfers)
+
+    def on_finish(step, outcome):
+        print("{}: {} ({})".format(step.name, *outcome))
+
+    results = Deployment(aws, sites, workers=workers,
+                         sync_workers=transfers).run(on_finish)
+    failed = [name for name, outcome in results.items()
+              if outcome[0] == FAILED]
+    if failed:
+        raise click.ClickException("{} steps failed".format(len(failed)))
+    print("{} sites deployed".format(len(sites)))
+
+
 @cli.command('find-cert')
 @click.argument('domain')
-def find_cert(domain):
+@click.pass_obj
+def find_cert(aws, domain):
     """Find SSL certificate for given domain."""
-    print(cert_manager.find_matching_cert(domain))
+    print(aws.cert_manager.find_matching_cert(domain))
 
 
 @cli.command('setup-cdn')
 @click.argument('domain')
 @click.argument('bucket')
-def setup_cdn(domain, bucket):
+@click.pass_obj
+def setup_cdn(aws, domain, bucket):
     """Set up an Cloud front CDN for domain."""
+    dist_manager = aws.dist_manager
+    cert_manager = aws.cert_manager
+    domain_manager = aws.domain_manager
     dist = dist_manager.find_matching_dist(domain)
 
     if not dist:
@@ -116,14 +341,17 @@ def setup_cdn(domain, bucket):
             return
 
         dist = dist_manager.create_dist(domain, cert)
-        print("Awaiting for distribution deployment")
-        dist_manager.await_deploy(dist)
 
-    zone = domain_manager.find_hostedzone(domain) \
-        or domain_manager.create_hostedzone(domain)
+    # The record only needs the distribution's domain name, so it is
+    # written while the distribution deploys.
+    deployed = dist_manager.track_deploy(dist)
+    zone = domain_manager.ensure_hostedzone(domain)
 
     domain_manager.create_cf_domain_record(zone, domain, dist['DomainName'])
 
+    if not deployed.done():
+        print("Awaiting for distribution deployment")
+    deployed.result()
     print("Domain configured: https://{}".format(domain))
 
     return
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""Class ZoneTrie to find the hosted zone of a domain name."""
+
+
+def labels(name):
+    """Split a domain name into lower case labels, last label first."""
+    return name.lower().rstrip('.').split('.')[::-1]
+
+
+def suffixes(name):
+    """Get domain name and its parent domains, longest first."""
+    parts = name.lower().rstrip('.').split('.')
+    return ['.'.join(parts[i:]) for i in range(len(parts))]
+
+
+class ZoneTrie:
+    """Hosted zones in a trie keyed by their labels, last label first.
+
+    Looking a domain up walks one node per label, and the deepest zone
+    on the way is the zone the domain belongs to.  Matching whole labels
+    keeps notexample.com out of example.com, and nested zones such as
+    sub.example.com win over example.com.
+    """
+
+    def __init__(self, zones=()):
+        """Create ZoneTrie holding the given zones."""
+        self.root = {}
+        self.zones = []
+        for zone in zones:
+            self.add(zone)
+
+    def add(self, zone):
+        """Add a zone, keeping the first one added for a name."""
+        node = self.root
+        for label in labels(zone['Name']):
+            node = node.setdefault(label, {})
+        # None is never a label, so it marks the zone of a node.
+        if None not in node:
+            node[None] = zone
+            self.zones.append(zone)
+
+    def longest_match(self, domain_name):
+        """Get the deepest zone containing domain_name or None."""
+        node = self.root
+        match = None
+        for label in labels(domain_name):
+            node = node.get(label)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
@@ -0,0 +1,48 @@
+import sys
+from pathlib import Path
+
+import click
+import boto3
+
+sys.path.insert(0, str(Path(__file__).resolve().parent / 'videoanalyzer'))
+
+from query import find_videos
+
+@click.option('--profile', default=None, help="Use a given AWS profile")
+@click.option('--table', required=True, help="Name of the label index table")
+@click.option('--endpoint-url', default=None,
+              help="DynamoDB endpoint, e.g. http://localhost:8000 for a "
+                   "local DynamoDB")
+@click.option('--min-confidence', default=0.0, show_default=True,
+              help="Only detections with at least this confidence")
+@click.option('--start', default=None, type=float,
+              help="Only detections after this many seconds")
+@click.option('--end', default=None, type=float,
+              help="Only detections before this many seconds")
+@click.argument('label')
+@click.command()
+def query_labels(profile, table, endpoint_url, min_confidence, start, end,
+                 label):
+    """List the videos in which <LABEL> was detected"""
+
+    session_cfg = {}
+    if profile:
+        session_cfg['profile_name'] = profile
+
+    session = boto3.Session(**session_cfg)
+    dynamodb = session.resource('dynamodb', endpoint_url=endpoint_url)
+
+    videos = find_videos(
+        dynamodb.Table(table), label, min_confidence,
+        None if start is None else int(start * 1000),
+        None if end is None else int(end * 1000))
+
+    for video in videos:
+        print('{} ({:.2f}%)'.format(video['videoName'],
+                                    video['peakConfidence']))
+        for first, last, peak, mean in video['intervals']:
+            print('  {:9.3f}s - {:9.3f}s  max {:6.2f}%  mean {:6.2f}%'.format(
+                first / 1000, last / 1000, peak, mean))
+
+if __name__ == '__main__':
+    query_labels()
@@ -0,0 +1,94 @@
+import os
+import sys
+from pathlib import Path
+
+import boto3
+import pytest
+from moto import mock_aws
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'videoanalyzer'))
+
+import summary
+from query import find_videos
+from summary import LabelSummary
+
+def detection(name, timestamp, confidence):
+    return {'Timestamp': timestamp,
+            'Label': {'Name': name, 'Confidence': confidence}}
+
+@pytest.fixture
+def index_table():
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        table = boto3.resource('dynamodb').create_table(
+            TableName='labels-index',
+            KeySchema=[
+                {'AttributeName': 'labelName', 'KeyType': 'HASH'},
+                {'AttributeName': 'indexKey', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[
+                {'AttributeName': 'labelName', 'AttributeType': 'S'},
+                {'AttributeName': 'indexKey', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST')
+        yield table
+
+def put_video(table, video_name, detections):
+    labels = LabelSummary()
+    for item in detections:
+        labels.add(item)
+    with table.batch_writer() as batch:
+        for item in labels.index_items(video_name, 'videos'):
+            batch.put_item(Item=item)
+
+@pytest.fixture
+def videos(index_table):
+    # Dog at 1-2 s and 60 s in a.mp4, 30 s in b.mp4, 5 s in c.mp4
+    put_video(index_table, 'a.mp4', [
+        detection('Dog', 1000, 80.0), detection('Dog', 2000, 95.5),
+        detection('Dog', 60000, 70.0), detection('Cat', 1000, 99.0)])
+    put_video(index_table, 'b.mp4', [detection('Dog', 30000, 60.0)])
+    put_video(index_table, 'c.mp4', [detection('Dog', 5000, 90.0)])
+    return index_table
+
+def test_find_videos_sorts_by_peak_confidence(videos):
+    found = list(find_videos(videos, 'Dog'))
+
+    assert [video['videoName'] for video in found] == \
+        ['a.mp4', 'c.mp4', 'b.mp4']
+    assert found[0]['peakConfidence'] == 95.5
+    assert found[0]['intervals'] == [
+        (1000, 2000, 95.5, 87.75), (60000, 60000, 70.0, 70.0)]
+
+def test_find_videos_min_confidence(videos):
+    found = list(find_videos(videos, 'Dog', min_confidence=85))
+
+    assert [video['videoName'] for video in found] == ['a.mp4', 'c.mp4']
+    assert found[0]['intervals'] == [(1000, 2000, 95.5, 87.75)]
+
+def test_find_videos_time_window(videos):
+    found = list(find_videos(videos, 'Dog', start=10000, end=59000))
+    assert [video['videoName'] for video in found] == ['b.mp4']
+
+    found = list(find_videos(videos, 'Dog', min_confidence=65,
+                             start=10000))
+    assert [(video['videoName'], video['intervals']) for video in found] == \
+        [('a.mp4', [(60000, 60000, 70.0, 70.0)])]
+
+def test_find_videos_unknown_label(videos):
+    assert list(find_videos(videos, 'Horse')) == []
+
+def test_index_items_describe_the_intervals_they_hold(index_table,
+                                                      monkeypatch):
+    monkeypatch.setattr(summary, 'MAX_INTERVALS', 2)
+    put_video(index_table, 'long.mp4', [
+        detection('Dog', 0, 50.0), detection('Dog', 10000, 60.0),
+        detection('Dog', 20000, 99.0)])
+
+    items = index_table.scan()['Items']
+    assert sorted((item['indexKey'], item['firstSeen'], item['lastSeen'],
+                   item['intervalCount']) for item in items) == [
+        ('060.00#long.mp4#000', 0, 10000, 2),
+        ('099.00#long.mp4#001', 20000, 20000, 1)]
+
+    found = list(find_videos(index_table, 'Dog', min_confidence=90))
+    assert [video['intervals'] for video in found] == \
+        [[(20000, 20000, 99.0, 99.0)]]
@@ -3,12 +3,20 @@ from pathlib import Path
 import click
 import boto3
 
+PART_SIZE = 8388608
+
 @click.option('--profile', default=None, help="Use a given AWS profile")
+@click.option('--resumable', is_flag=True,
+              help="Checkpoint the upload so a rerun resumes it")
 @click.argument('pathname', type=click.Path(exists=True))
 @click.argument('bucketname')
 @click.command()
-def upload_file(profile, pathname, bucketname):
-    """Upload <PATHNAME> to <BUCKETNAME>"""
+def upload_file(profile, resumable, pathname, bucketname):
+    """Upload <PATHNAME> to <BUCKETNAME>
+
+    --resumable needs the webauto package of 1-webauto to be installed,
+    e.g. with pip install -e ../1-webauto.
+    """
 
     session_cfg = {}
     if profile:
@@ -20,6 +28,16 @@ def upload_file(profile, pathname, bucketname):
     bucket = s3.Bucket(bucketname)
     path = Path(pathname).expanduser().resolve()
 
+    if resumable:
+        try:
+            from webauto.resumable import ResumableUpload
+        except ImportError:
+            raise click.UsageError(
+                "--resumable needs webauto: pip install -e ../1-webauto")
+        ResumableUpload(s3.meta.client, bucketname, str(path.name),
+                        str(path), PART_SIZE).upload()
+        return
+
     bucket.upload_file(str(path), str(path.name))
 
 if __name__ == '__main__':
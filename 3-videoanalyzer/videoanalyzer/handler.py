@@ -4,7 +4,12 @@ import os
 
 import urllib
 
+from decimal import Decimal
+
 import boto3
+from boto3.dynamodb.conditions import Key
+
+from summary import LabelSummary
 
 def start_content_detection(bucket, key):
     reko_client = boto3.client('rekognition')
@@ -20,30 +25,70 @@ def start_content_detection(bucket, key):
     print(response)
     return
 
+# Serialized size of the labels of a segment item.  A segment is cut at
+# the next timestamp once it reaches SEGMENT_BYTES, and within a
+# timestamp at MAX_SEGMENT_BYTES, leaving a margin under the 400 KB
+# DynamoDB item limit for the estimate and the other attributes
+SEGMENT_BYTES = 300000
+MAX_SEGMENT_BYTES = 350000
+
 def get_video_labels(job_id):
     reko_client = boto3.client('rekognition')
-    response = reko_client.get_label_detection(JobId=job_id)
+    params = {'JobId': job_id, 'SortBy': 'TIMESTAMP'}
 
         # get label detection returns only 1000 labels at a single call
-        # use next token to retrive next set of results
+        # use next token to retrive next set of results, one page at a
+        # time so a long video is never held in memory
 
         # refer doc
         # https://boto3.amazonaws.com/v1/documentation/api/latest/reference/services/rekognition.html#Rekognition.Client.get_label_detection
 
-    next_token = response.get('NextToken', None)
-
-    while next_token:
-        next_page = rekognition_client.get_label_detection(
-            JobId=job_id,
-            NextToken=next_token
-        )
-
-        next_token = next_page.get('NextToken', None)
-
-        # Use extend function instead of append function here
-        response['Labels'].extend(next_page['Labels'])
-
-    return response
+    while True:
+        page = reko_client.get_label_detection(**params)
+        yield page
+
+        next_token = page.get('NextToken', None)
+        if not next_token:
+            return
+        params['NextToken'] = next_token
+
+def iter_labels(pages, video):
+    # Copy the video details of the first page into video
+    for page in pages:
+        for field in ('VideoMetadata', 'LabelModelVersion'):
+            if field in page and field not in video:
+                video[field] = page[field]
+        yield from page['Labels']
+
+def label_size(label):
+    # JSON spends at least as many bytes as DynamoDB on names, numbers
+    # and nesting, so it bounds the stored size of a label
+    return len(json.dumps(label, separators=(',', ':')))
+
+def label_segments(labels, size=SEGMENT_BYTES, max_size=MAX_SEGMENT_BYTES):
+    # Labels are sorted by timestamp, a segment is cut between two
+    # timestamps once it holds size bytes, and between two labels of
+    # one timestamp only if it would exceed max_size
+    segment = []
+    segment_size = 0
+    for label in labels:
+        added = label_size(label) + 1
+        if segment and (segment_size + added > max_size or
+                        segment_size >= size and
+                        label['Timestamp'] != segment[-1]['Timestamp']):
+            yield segment
+            segment = []
+            segment_size = 0
+        segment.append(label)
+        segment_size += added
+
+    if segment:
+        yield segment
+
+def segment_key(start, end, number):
+    # Zero padded milliseconds, so segments sort by time, and the segment
+    # number, as segments cut within a timestamp share their times
+    return 'segment#{:010d}-{:010d}#{:05d}'.format(start, end, number)
 
 def make_item(data):
 
@@ -53,26 +98,109 @@ def make_item(data):
     if isinstance(data, list):
         return [ make_item(v) for v in data ]
 
+    # Numbers are stored as numbers, 4 places are enough for confidence
+    # percentages and bounding box ratios
     if isinstance(data, float):
-        return str(data)
+        return Decimal(str(round(data, 4)))
 
     return data
 
-def put_labels_in_db(data, video_name, video_bucket):
-    del data['ResponseMetadata']
-    del data['JobStatus']
+def existing_keys(videos_table, video_name):
+    # Returns the item keys of the video and its label index keys
+    keys = set()
+    index_keys = set()
+    params = {
+        'KeyConditionExpression': Key('videoName').eq(video_name),
+        'ProjectionExpression': 'itemKey, indexKeys'
+    }
+    while True:
+        response = videos_table.query(**params)
+        for item in response['Items']:
+            keys.add(item['itemKey'])
+            index_keys.update(tuple(key) for key in item.get('indexKeys', []))
+        if 'LastEvaluatedKey' not in response:
+            return keys, index_keys
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def put_labels_in_index(summary, video_name, video_bucket, stale_index_keys):
+    # Writes the label to video index of the video and returns its keys
+    dynamodb = boto3.resource('dynamodb')
+
+    table_name = os.environ['INDEX_TABLE_NAME']
+    index_table = dynamodb.Table(table_name)
 
-    data['videoName'] = video_name
-    data['videoBucket'] = video_bucket
+    index_keys = []
+    with index_table.batch_writer() as batch:
+        for item in summary.index_items(video_name, video_bucket):
+            batch.put_item(Item=item)
+            index_keys.append([item['labelName'], item['indexKey']])
+            stale_index_keys.discard(tuple(index_keys[-1]))
 
+        for label_name, index_key in stale_index_keys:
+            batch.delete_item(Key={'labelName': label_name,
+                                   'indexKey': index_key})
+
+    return index_keys
+
+def put_labels_in_db(pages, video_name, video_bucket):
     dynamodb = boto3.resource('dynamodb')
 
     table_name = os.environ['DYNAMODB_TABLE_NAME']
     videos_table = dynamodb.Table(table_name)
 
-    data = make_item(data)
-
-    videos_table.put_item(Item=data)
+    # Items of an earlier analysis of the same video that are not
+    # overwritten are deleted at the end
+    stale_keys, stale_index_keys = existing_keys(videos_table, video_name)
+
+    video = {
+        'videoName': video_name,
+        'itemKey': 'video',
+        'videoBucket': video_bucket
+    }
+    segment_count = 0
+
+    # Raw detections are only kept when asked for, the label summary
+    # items hold the intervals of every label
+    summary = LabelSummary()
+    labels = summary.collect(iter_labels(pages, video))
+    store_raw = os.environ.get('STORE_RAW_LABELS', 'false') == 'true'
+
+    with videos_table.batch_writer() as batch:
+        if not store_raw:
+            for _ in labels:
+                pass
+            labels = []
+
+        for segment in label_segments(labels):
+            start = segment[0]['Timestamp']
+            end = segment[-1]['Timestamp']
+            item = {
+                'videoName': video_name,
+                'itemKey': segment_key(start, end, segment_count),
+                'startTimestamp': start,
+                'endTimestamp': end,
+                'labels': segment
+            }
+            batch.put_item(Item=make_item(item))
+            stale_keys.discard(item['itemKey'])
+            segment_count += 1
+
+        for item in summary.items(video_name):
+            batch.put_item(Item=item)
+            stale_keys.discard(item['itemKey'])
+
+        video['segmentCount'] = segment_count
+        video['labelNames'] = summary.label_names()
+        # The index is written before the video item, whose indexKeys
+        # let the next analysis of the video remove stale entries
+        video['indexKeys'] = put_labels_in_index(
+            summary, video_name, video_bucket, stale_index_keys)
+        batch.put_item(Item=make_item(video))
+        stale_keys.discard('video')
+
+        for item_key in stale_keys:
+            batch.delete_item(Key={'videoName': video_name,
+                                   'itemKey': item_key})
 
     return
 
@@ -95,8 +223,7 @@ def handle_label_detection(event, context):
         s3_object = message['Video']['S3ObjectName']
         s3_bucket = message['Video']['S3Bucket']
 
-        response = get_video_labels(job_id)
-        print(response)
-        put_labels_in_db(response, s3_object, s3_bucket)
+        pages = get_video_labels(job_id)
+        put_labels_in_db(pages, s3_object, s3_bucket)
 
     return
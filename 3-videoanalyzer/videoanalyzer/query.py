@@ -0,0 +1,59 @@
+from boto3.dynamodb.conditions import Attr, Key
+
+from summary import confidence_key, to_decimal, unpack_intervals
+
+# The label index table has the label name as hash key and
+# index_key(peak confidence, video name, part) as range key, so every
+# query below is a single Query of one label, highest confidence first.
+# A label seen in more than MAX_INTERVALS intervals of a video is indexed
+# in parts, and each matching part is yielded on its own
+
+def find_videos(index_table, label_name, min_confidence=0, start=None,
+                end=None):
+    # Yields {'videoName', 'videoBucket', 'peakConfidence', 'intervals'}
+    # for every video where label_name was detected with min_confidence
+    # or more, within [start, end] milliseconds when given.  intervals
+    # lists the matching (start, end, max, mean) intervals
+    params = {
+        'KeyConditionExpression': Key('labelName').eq(label_name) &
+        Key('indexKey').gte(confidence_key(min_confidence)),
+        'ScanIndexForward': False
+    }
+
+    conditions = [Attr('peakConfidence').gte(to_decimal(min_confidence))]
+    if start is not None:
+        conditions.append(Attr('lastSeen').gte(start))
+    if end is not None:
+        conditions.append(Attr('firstSeen').lte(end))
+    condition = conditions[0]
+    for other in conditions[1:]:
+        condition = condition & other
+    params['FilterExpression'] = condition
+
+    while True:
+        response = index_table.query(**params)
+        for item in response['Items']:
+            intervals = matching_intervals(item, min_confidence, start, end)
+            if intervals:
+                yield {
+                    'videoName': item['videoName'],
+                    'videoBucket': item['videoBucket'],
+                    'peakConfidence': float(item['peakConfidence']),
+                    'intervals': intervals
+                }
+
+        if 'LastEvaluatedKey' not in response:
+            return
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def matching_intervals(item, min_confidence=0, start=None, end=None):
+    times, confidence = unpack_intervals(item)
+    keep = confidence[:, 0] >= min_confidence
+    if start is not None:
+        keep &= times[:, 1] >= start
+    if end is not None:
+        keep &= times[:, 0] <= end
+
+    return [(int(first), int(last), float(peak), float(mean))
+            for (first, last), (peak, mean)
+            in zip(times[keep], confidence[keep])]
@@ -0,0 +1,144 @@
+from array import array
+
+from decimal import Decimal
+
+import numpy as np
+
+# Detections of a label less than this many milliseconds apart belong to
+# one interval
+MERGE_GAP_MS = 1500
+
+# Intervals per label item, at 12 bytes each an item stays under 200 KB
+MAX_INTERVALS = 16384
+
+def to_decimal(value, places=2):
+    return Decimal(str(round(float(value), places)))
+
+def confidence_key(confidence):
+    # Zero padded, so keys starting with it sort by confidence
+    return '{:06.2f}'.format(float(confidence))
+
+def index_key(confidence, video_name, part=0):
+    # Confidence first, so index entries of a label sort by confidence
+    # and a threshold is a key range
+    return '{}#{}#{:03d}'.format(confidence_key(confidence), video_name, part)
+
+def pack_intervals(start, end, max_confidence, mean_confidence):
+    # [start, end] pairs as little endian uint32 milliseconds and
+    # [max, mean] pairs as uint16 hundredths of a percent
+    times = np.stack([start, end], axis=1).astype('<u4')
+    confidence = np.rint(
+        np.stack([max_confidence, mean_confidence], axis=1) * 100)
+    return times.tobytes(), confidence.astype('<u2').tobytes()
+
+def unpack_intervals(item):
+    # Returns an (n, 2) array of [start, end] milliseconds and an (n, 2)
+    # array of [max, mean] confidence percentages
+    times = np.frombuffer(bytes(item['intervals']), dtype='<u4')
+    confidence = np.frombuffer(bytes(item['confidence']), dtype='<u2')
+    return times.reshape(-1, 2), confidence.reshape(-1, 2) / 100.0
+
+class LabelSummary:
+    # Collects the timestamp and confidence of every detection per label
+    # in typed arrays, 12 bytes a detection, and merges them into time
+    # intervals with NumPy once all pages are read
+
+    def __init__(self):
+        self.timestamps = {}
+        self.confidences = {}
+        self.parents = {}
+        self.merged = {}
+
+    def add(self, detection):
+        label = detection['Label']
+        name = label['Name']
+        if name not in self.timestamps:
+            self.timestamps[name] = array('q')
+            self.confidences[name] = array('f')
+            self.parents[name] = [
+                parent['Name'] for parent in label.get('Parents', [])]
+
+        self.timestamps[name].append(detection['Timestamp'])
+        self.confidences[name].append(label['Confidence'])
+
+    def collect(self, detections):
+        # Pass detections through, adding each one to the summary
+        for detection in detections:
+            self.add(detection)
+            yield detection
+
+    def label_names(self):
+        return sorted(self.timestamps)
+
+    def intervals(self, name):
+        # Returns start, end, max and mean confidence arrays, one entry
+        # per interval
+        if name not in self.merged:
+            self.merged[name] = self.merge(name)
+        return self.merged[name]
+
+    def merge(self, name):
+        timestamps = np.frombuffer(self.timestamps[name], dtype=np.int64)
+        confidences = np.frombuffer(self.confidences[name], dtype=np.float32)
+        order = np.argsort(timestamps, kind='stable')
+        timestamps = timestamps[order]
+        confidences = confidences[order].astype(np.float64)
+
+        starts = np.flatnonzero(np.diff(timestamps) > MERGE_GAP_MS) + 1
+        starts = np.concatenate(([0], starts))
+        ends = np.append(starts[1:], len(timestamps))
+
+        return (timestamps[starts],
+                timestamps[ends - 1],
+                np.maximum.reduceat(confidences, starts),
+                np.add.reduceat(confidences, starts) / (ends - starts))
+
+    def parts(self, name):
+        # Yields (part, start, end, max, mean) for every MAX_INTERVALS
+        # intervals of the label
+        start, end, max_confidence, mean_confidence = self.intervals(name)
+        for part, first in enumerate(range(0, len(start), MAX_INTERVALS)):
+            chunk = slice(first, first + MAX_INTERVALS)
+            yield (part, start[chunk], end[chunk], max_confidence[chunk],
+                   mean_confidence[chunk])
+
+    def items(self, video_name):
+        # One item per label, split into parts of MAX_INTERVALS intervals
+        for name in self.label_names():
+            for part, start, end, max_confidence, mean_confidence in \
+                    self.parts(name):
+                times, confidence = pack_intervals(
+                    start, end, max_confidence, mean_confidence)
+                yield {
+                    'videoName': video_name,
+                    'itemKey': 'label#{}#{:03d}'.format(name, part),
+                    'labelName': name,
+                    'parents': self.parents[name],
+                    'intervalCount': len(start),
+                    'maxConfidence': to_decimal(max_confidence.max()),
+                    'intervals': times,
+                    'confidence': confidence
+                }
+
+    def index_items(self, video_name, video_bucket):
+        # One label to video index item per label and part of
+        # MAX_INTERVALS intervals, its attributes covering the intervals
+        # it holds
+        for name in self.label_names():
+            for part, start, end, max_confidence, mean_confidence in \
+                    self.parts(name):
+                peak = max_confidence.max()
+                times, confidence = pack_intervals(
+                    start, end, max_confidence, mean_confidence)
+                yield {
+                    'labelName': name,
+                    'indexKey': index_key(peak, video_name, part),
+                    'videoName': video_name,
+                    'videoBucket': video_bucket,
+                    'peakConfidence': to_decimal(peak),
+                    'firstSeen': int(start[0]),
+                    'lastSeen': int(end[-1]),
+                    'intervalCount': len(start),
+                    'intervals': times,
+                    'confidence': confidence
+                }